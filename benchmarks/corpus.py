@@ -0,0 +1,130 @@
+"""Synthetic banking app screenshots with known balances.
+
+Each app layout draws its balance at a fixed place relative to the screen, surrounded by the kind
+of text a real app shows (labels, percentages, dates and smaller amounts), so both the image
+hashes and the nearest-balance selection have something to get wrong.
+"""
+import io
+import random
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Iterator, List, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+RESOLUTIONS = [(720, 1280), (1080, 2340), (1440, 3120), (2560, 1440)]
+THEMES = ['light', 'dark']
+
+# Formats an amount the way apps in different locales do, and the currency symbol it ends up with
+CURRENCY_FORMATS = {
+    'gbp': lambda a: f'£{a:,.2f}',
+    'usd': lambda a: f'${a:,.2f}',
+    'eur': lambda a: f'{a:,.2f} €'.replace(',', ' ').replace('.', ',').replace(' ', '.'),
+    'eur_space': lambda a: f'{a:,.2f} €'.replace(',', ' ').replace('.', ','),
+}
+
+
+@dataclass
+class AppLayout:
+    name: str
+    accent: Tuple[int, int, int]
+    # Location of the balance as fractions of the screen width and height
+    balance_at: Tuple[float, float]
+    # Relative size of the balance text
+    balance_scale: float
+    rows: int
+
+
+APPS = [
+    AppLayout('Trading', (18, 140, 230), (0.08, 0.18), 1.6, 6),
+    AppLayout('Savings', (110, 60, 200), (0.30, 0.32), 2.0, 3),
+    AppLayout('Pension', (230, 120, 30), (0.08, 0.45), 1.3, 5),
+    AppLayout('Crypto', (40, 170, 90), (0.25, 0.12), 1.8, 8),
+]
+
+
+@dataclass
+class Screenshot:
+    app: str
+    resolution: Tuple[int, int]
+    theme: str
+    currency: str
+    amount: Decimal
+    # Top-left corner of the balance text, in the 2x upscaled space the bot stores locations in
+    x: int
+    y: int
+    data: bytes
+
+
+# Fonts tried in order, the first must have glyphs for every currency symbol to get a fair OCR result
+FONTS = ['DejaVuSans.ttf', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf', 'LiberationSans-Regular.ttf']
+
+
+def _font(size: int) -> ImageFont.ImageFont:
+    for font in FONTS:
+        try:
+            return ImageFont.truetype(font, size)
+        except OSError:
+            continue
+    # Pillow's own font has no £ or € glyphs
+    return ImageFont.load_default(size=size)
+
+
+def render(app: AppLayout, resolution: Tuple[int, int], theme: str, currency: str, amount: Decimal,
+           seed: int = 0) -> Screenshot:
+    rng = random.Random(seed)
+    width, height = resolution
+    background, foreground, muted = ((255, 255, 255), (20, 20, 20), (120, 120, 120)) if theme == 'light' \
+        else ((18, 18, 18), (235, 235, 235), (150, 150, 150))
+
+    img = Image.new('RGB', resolution, background)
+    draw = ImageDraw.Draw(img)
+    unit = min(width, height) / 20
+
+    # App bar and navigation bar in the app's colours
+    draw.rectangle((0, 0, width, int(unit * 2.5)), fill=app.accent)
+    draw.text((unit, unit * 0.6), app.name, font=_font(int(unit)), fill=(255, 255, 255))
+    draw.rectangle((0, height - int(unit * 2.5), width, height), fill=app.accent)
+
+    x, y = int(app.balance_at[0] * width), int(app.balance_at[1] * height)
+    draw.text((x, y - unit * 1.2), 'Total balance', font=_font(int(unit * 0.6)), fill=muted)
+
+    balance_font = _font(int(unit * app.balance_scale))
+    balance_text = CURRENCY_FORMATS[currency](amount)
+    draw.text((x, y), balance_text, font=balance_font, fill=foreground)
+    left, top, _, _ = draw.textbbox((x, y), balance_text, font=balance_font)
+
+    change = rng.uniform(-5, 5)
+    draw.text((x, y + unit * app.balance_scale * 1.3), f'{change:+.2f}% today', font=_font(int(unit * 0.6)),
+              fill=(40, 160, 60) if change > 0 else (200, 50, 50))
+
+    row_top = y + unit * (app.balance_scale + 3)
+    row_font = _font(int(unit * 0.7))
+    for i in range(app.rows):
+        row_y = row_top + i * unit * 1.8
+        if row_y > height - unit * 4:
+            break
+        draw.text((unit, row_y), f'{rng.randint(1, 28)} Mar', font=row_font, fill=muted)
+        draw.text((width * 0.6, row_y), CURRENCY_FORMATS[currency](Decimal(rng.randint(100, 99999)) / 100),
+                  font=row_font, fill=foreground)
+
+    b = io.BytesIO()
+    img.save(b, format='PNG')
+    return Screenshot(app.name, resolution, theme, currency, amount, left * 2, top * 2, b.getvalue())
+
+
+def templates(resolution: Tuple[int, int] = (1080, 2340)) -> List[Screenshot]:
+    """One screenshot per app, as it would have been sent during /setup."""
+    return [render(app, resolution, 'light', 'gbp', Decimal('1000.00'), seed=i) for i, app in enumerate(APPS)]
+
+
+def corpus(samples: int = 1, seed: int = 0) -> Iterator[Screenshot]:
+    """Every app at every resolution, theme and currency format, ``samples`` times with different balances."""
+    rng = random.Random(seed)
+    for app in APPS:
+        for resolution in RESOLUTIONS:
+            for theme in THEMES:
+                for currency in CURRENCY_FORMATS:
+                    for _ in range(samples):
+                        amount = Decimal(rng.randint(100, 99999999)) / 100
+                        yield render(app, resolution, theme, currency, amount, seed=rng.randint(0, 2 ** 32))
@@ -0,0 +1,61 @@
+"""Compares the OCR backends on the same screenshots.
+
+Every image is decoded and preprocessed once, then OCR'd by each backend ``--repeat`` times. The
+latency of each backend is reported along with whether it found the same prices as the first.
+
+    python benchmarks/ocr_backends.py /path/to/screenshots --repeat 5
+"""
+import argparse
+import pathlib
+import statistics
+import time
+
+from price_parser import Price
+
+from firefly_bot.ocr import OCR_BACKENDS, get_ocr_backend
+from firefly_bot.screenshot import Screenshot
+from firefly_bot.vision import _preprocess_image
+
+
+def _prices(data: dict) -> set:
+    prices = (Price.fromstring(s) for s in data.get('text'))
+    return {(p.currency, p.amount) for p in prices if p.amount is not None and p.currency is not None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', type=pathlib.Path, help='Directory of screenshots')
+    parser.add_argument('--repeat', type=int, default=3, help='OCR runs per image and backend')
+    parser.add_argument('--backends', nargs='+', default=list(OCR_BACKENDS), choices=list(OCR_BACKENDS))
+    args = parser.parse_args()
+
+    images = [p for p in sorted(args.images.iterdir()) if p.suffix.lower() in ('.png', '.jpg', '.jpeg')]
+    preprocessed = [_preprocess_image(Screenshot(p.read_bytes()).gray) for p in images]
+
+    timings = {name: [] for name in args.backends}
+    agreement = {name: 0 for name in args.backends}
+    for img in preprocessed:
+        reference = None
+        for name in args.backends:
+            backend = get_ocr_backend(name)
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                data = backend.image_to_data(img)
+                timings[name].append(time.perf_counter() - start)
+
+            prices = _prices(data)
+            reference = prices if reference is None else reference
+            agreement[name] += prices == reference
+
+    print(f'{len(images)} images, {args.repeat} runs each')
+    print(f'{"backend":<12} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"agree":>7}')
+    for name, samples in timings.items():
+        if not samples:
+            continue
+        p95 = statistics.quantiles(samples, n=20)[-1] if len(samples) > 1 else samples[0]
+        print(f'{name:<12} {statistics.mean(samples) * 1000:>9.1f} {statistics.median(samples) * 1000:>9.1f} '
+              f'{p95 * 1000:>9.1f} {agreement[name]:>4}/{len(images)}')
+
+
+if __name__ == '__main__':
+    main()
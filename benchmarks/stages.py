@@ -0,0 +1,168 @@
+"""Times every stage of the screenshot pipeline on a synthetic corpus and checks its accuracy.
+
+Stages are timed separately (decode, hash, match, preprocess, ocr, parse, nearest) along with the
+whole balance lookup as the bot runs it (pipeline). Latency percentiles and accuracy can be saved
+as a baseline and later runs compared against it:
+
+    python benchmarks/stages.py --save baseline.json
+    python benchmarks/stages.py --compare baseline.json
+
+Needs a config.yml in the working directory, only its bot.screenshots settings are used.
+"""
+import argparse
+import json
+import pathlib
+import platform
+import statistics
+import sys
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+import imagehash
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+
+import corpus  # noqa: E402
+from firefly_bot.config import init_config  # noqa: E402
+from firefly_bot.matching import BalanceIndex, TemplateMatrix  # noqa: E402
+from firefly_bot.ocr import OCR_BACKENDS, get_ocr_backend  # noqa: E402
+from firefly_bot.screenshot import Screenshot  # noqa: E402
+from firefly_bot.utils import _OCR_SCALE  # noqa: E402
+from firefly_bot.vision import _get_balances_from_data, _get_nearest_balances_from_screenshot, \
+    _preprocess_image  # noqa: E402
+
+STAGES = ['decode', 'hash', 'match', 'preprocess', 'ocr', 'parse', 'nearest', 'pipeline']
+
+
+class Timer:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def __call__(self, stage: str, fn: Callable, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.samples[stage].append(time.perf_counter() - start)
+        return result
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        report = dict()
+        for stage in STAGES:
+            samples = self.samples.get(stage)
+            if not samples:
+                continue
+            q = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+            report[stage] = {'mean': statistics.mean(samples) * 1000, 'p50': q[49] * 1000,
+                             'p90': q[89] * 1000, 'p99': q[98] * 1000, 'n': len(samples)}
+        return report
+
+
+def _template_accounts(hash_func: Callable) -> List[dict]:
+    accounts = []
+    for i, template in enumerate(corpus.templates()):
+        width, height = template.resolution
+        accounts.append({
+            'id': i,
+            'name': template.app,
+            'image': {
+                'x': template.x, 'y': template.y, 'width': width, 'height': height,
+                'hash': hash_func(Screenshot(template.data).image).hash.tolist()
+            }
+        })
+    return accounts
+
+
+def _amount_matches(balance, amount) -> bool:
+    return balance is not None and balance.price.amount is not None and balance.price.amount == amount
+
+
+def run(args) -> dict:
+    hash_func = getattr(imagehash, args.hash)
+    accounts = _template_accounts(hash_func)
+    templates = TemplateMatrix(accounts)
+    by_app = {account.get('name'): account for account in accounts}
+    ocr_backend = get_ocr_backend(args.ocr) if not args.no_ocr else None
+
+    timer = Timer()
+    correct = defaultdict(int)
+    total = 0
+    for screenshot in corpus.corpus(samples=args.samples, seed=args.seed):
+        total += 1
+        image = by_app[screenshot.app].get('image')
+
+        decoded = Screenshot(screenshot.data)
+        img = timer('decode', lambda: decoded.gray)
+        image_hash = timer('hash', lambda: hash_func(decoded.image))
+        matches = timer('match', templates.rank, image_hash)
+        correct['match'] += bool(matches) and matches[0].account.get('name') == screenshot.app
+
+        if ocr_backend is None:
+            continue
+
+        th = timer('preprocess', _preprocess_image, img)
+        data = timer('ocr', ocr_backend.image_to_data, th)
+        balances = timer('parse', _get_balances_from_data, data)
+
+        width, height = screenshot.resolution
+        x = image.get('x') * width / image.get('width')
+        y = image.get('y') * height / image.get('height')
+        balance = timer('nearest', lambda: BalanceIndex(balances).nearest(x, y))
+        correct['nearest'] += _amount_matches(balance, screenshot.amount)
+
+        balance, = timer('pipeline', _get_nearest_balances_from_screenshot,
+                         Screenshot(screenshot.data), [image])
+        correct['pipeline'] += _amount_matches(balance, screenshot.amount)
+
+        if args.verbose and not _amount_matches(balance, screenshot.amount):
+            print(f'MISS {screenshot.app} {screenshot.resolution} {screenshot.theme} {screenshot.currency}: '
+                  f'expected {screenshot.amount}, got {balance.price if balance else None}', file=sys.stderr)
+
+    return {
+        'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'hash': args.hash,
+                 'ocr': None if args.no_ocr else args.ocr, 'scale': _OCR_SCALE, 'screenshots': total},
+        'latency_ms': timer.percentiles(),
+        'accuracy': {k: v / total for k, v in correct.items()}
+    }
+
+
+def _print_report(report: dict, baseline: dict = None):
+    print(f"{report['meta']['screenshots']} screenshots, hash {report['meta']['hash']}, "
+          f"ocr {report['meta']['ocr']}")
+    print(f'{"stage":<11} {"mean ms":>9} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9}' +
+          (f' {"p50 vs base":>12}' if baseline else ''))
+    for stage, p in report['latency_ms'].items():
+        line = f'{stage:<11} {p["mean"]:>9.2f} {p["p50"]:>9.2f} {p["p90"]:>9.2f} {p["p99"]:>9.2f}'
+        base = (baseline or dict()).get('latency_ms', dict()).get(stage)
+        if base:
+            line += f' {(p["p50"] - base["p50"]) / base["p50"] * 100:>+11.1f}%'
+        print(line)
+
+    print('accuracy: ' + ', '.join(
+        f'{k} {v:.1%}' + (f' (base {baseline["accuracy"][k]:.1%})'
+                          if baseline and k in baseline.get('accuracy', dict()) else '')
+        for k, v in report['accuracy'].items()))
+
+
+def main():
+    init_config()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hash', default='colorhash', help='imagehash function for matching')
+    parser.add_argument('--ocr', default='pytesseract', choices=list(OCR_BACKENDS))
+    parser.add_argument('--no-ocr', action='store_true', help='Only time decoding, hashing and matching')
+    parser.add_argument('--samples', type=int, default=1, help='Balances rendered per layout, theme and format')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', type=pathlib.Path, help='Write the results to this baseline file')
+    parser.add_argument('--compare', type=pathlib.Path, help='Compare the results with this baseline file')
+    parser.add_argument('--verbose', action='store_true', help='Print every screenshot read wrong')
+    args = parser.parse_args()
+
+    report = run(args)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    _print_report(report, baseline)
+
+    if args.save:
+        args.save.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Times how long the bot takes to start, each run in a fresh interpreter.
+
+Startup is split into importing the bot (import), loading config.yml (config) and building the
+application with every handler registered (build), without connecting to Telegram. The heavy
+libraries that got imported along the way are listed too, only the worker processes should need
+them. Runs can be saved as a baseline and compared against, or appended to a history file to
+track startup time across commits:
+
+    python benchmarks/startup.py --save startup.json
+    python benchmarks/startup.py --compare startup.json
+    python benchmarks/startup.py --history startup-history.jsonl
+
+Needs a config.yml in the working directory, any token in the right format will do.
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+
+STAGES = ['import', 'config', 'build', 'total']
+
+# Only the worker processes need these
+HEAVY_MODULES = ['cv2', 'numpy', 'imagehash', 'PIL', 'pytesseract', 'tesserocr', 'price_parser',
+                 'firefly_bot.vision', 'firefly_bot.matching']
+
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import firefly_bot
+imported = time.perf_counter()
+firefly_bot.init_config()
+configured = time.perf_counter()
+firefly_bot._build_application()
+built = time.perf_counter()
+print(json.dumps({
+    'import': imported - start, 'config': configured - imported, 'build': built - configured, 'total': built - start,
+    'modules': [m for m in %r if m in sys.modules]
+}))
+'''
+
+
+def _probe() -> dict:
+    output = subprocess.run([sys.executable, '-c', _PROBE % HEAVY_MODULES], check=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True, cwd=pathlib.Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    samples = [_probe() for _ in range(args.repeat)]
+    return {
+        'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'runs': args.repeat,
+                 'commit': _git_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds')},
+        'latency_ms': {stage: {'p50': statistics.median(s[stage] for s in samples) * 1000,
+                               'min': min(s[stage] for s in samples) * 1000} for stage in STAGES},
+        'modules': samples[-1]['modules']
+    }
+
+
+def _print_report(report: dict, baseline: dict = None):
+    print(f"{report['meta']['runs']} runs, commit {report['meta']['commit']}")
+    print(f'{"stage":<8} {"p50 ms":>9} {"min ms":>9}' + (f' {"p50 vs base":>12}' if baseline else ''))
+    for stage, p in report['latency_ms'].items():
+        line = f'{stage:<8} {p["p50"]:>9.1f} {p["min"]:>9.1f}'
+        base = (baseline or dict()).get('latency_ms', dict()).get(stage)
+        if base:
+            line += f' {(p["p50"] - base["p50"]) / base["p50"] * 100:>+11.1f}%'
+        print(line)
+
+    print('heavy modules imported: ' + (', '.join(report['modules']) or 'none'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters started')
+    parser.add_argument('--save', type=pathlib.Path, help='Write the results to this baseline file')
+    parser.add_argument('--compare', type=pathlib.Path, help='Compare the results with this baseline file')
+    parser.add_argument('--history', type=pathlib.Path, help='Append the results to this JSON lines file')
+    args = parser.parse_args()
+
+    report = run(args)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    _print_report(report, baseline)
+
+    if args.save:
+        args.save.write_text(json.dumps(report, indent=2))
+    if args.history:
+        with args.history.open('a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+if __name__ == '__main__':
+    main()
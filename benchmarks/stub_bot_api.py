@@ -0,0 +1,280 @@
+"""A local stand-in for the Telegram Bot API that enforces its flood limits, to load the bot against.
+
+A number of simulated users each send a burst of screenshots at once, optionally as an album, and
+every message the bot sends back is counted. Like Telegram, more than ``--rate`` messages a second
+overall or ``--chat-rate`` a second to one chat are turned away with a 429 and a ``retry_after``.
+Updates are served by getUpdates, or posted to the bot's listener once it has set a webhook, so
+both modes can be run end to end. Point the bot at it, with the simulated users allowed in
+config.yml, and stop it with Ctrl+C for the numbers:
+
+    python benchmarks/stub_bot_api.py ~/screenshots --users 42,43,44 --burst 5
+
+with ``base_url: http://localhost:8081/bot`` and ``base_file_url: http://localhost:8081/file/bot``
+under ``telegram`` in the bot's config.yml, plus ``mode: webhook`` and ``webhook.url:
+http://localhost:8443`` for webhook mode. Users without accounts set up get no replies at all.
+"""
+import argparse
+import collections
+import json
+import math
+import pathlib
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Tuple, Union
+from urllib.parse import parse_qsl
+
+_IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Methods that send a message to a chat, which the flood limits apply to
+_SEND_METHODS = ('sendMessage', 'editMessageText')
+
+# Telegram doesn't time messages to the millisecond either, one that is a little early still goes through
+_SLACK = 0.05
+
+
+class _Window:
+    """Counts events over the last ``period`` seconds."""
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.period = period
+        self._times: Deque[float] = collections.deque()
+
+    def retry_after(self, now: float) -> int:
+        """Seconds until another event fits, 0 when it fits now."""
+        while self._times and self._times[0] <= now - self.period + _SLACK:
+            self._times.popleft()
+        if len(self._times) < self.limit:
+            return 0
+        return max(1, math.ceil(self._times[0] + self.period - now))
+
+    def add(self, now: float):
+        self._times.append(now)
+
+
+class StubBotApi:
+    def __init__(self, screenshots: List[pathlib.Path], users: List[int], burst: int, album: bool,
+                 rate: int, chat_rate: int):
+        self.screenshots = screenshots
+        self._lock = threading.Lock()
+        self._updates: List[dict] = []
+        self._released = threading.Event()
+        self._global = _Window(rate, 1)
+        self._chats: Dict[int, _Window] = collections.defaultdict(lambda: _Window(chat_rate, 1))
+        self._message_id = 0
+        # Set by the bot's setWebhook, updates are then posted to it rather than served by getUpdates
+        self._webhook: Union[dict, None] = None
+        self._posted = False
+        self.started = time.monotonic()
+        self.stats = collections.Counter()
+        # Seconds from the burst to each reply a chat got, and the text of each
+        self.replies: Dict[int, List[float]] = collections.defaultdict(list)
+        self.texts: Dict[int, List[str]] = collections.defaultdict(list)
+
+        for user in users:
+            for i in range(burst):
+                self._updates.append(self._photo_update(user, (user + i) % len(screenshots),
+                                                        f'album{user}' if album else None))
+
+    def _next_message_id(self) -> int:
+        self._message_id += 1
+        return self._message_id
+
+    def _photo_update(self, user: int, screenshot: int, media_group: str = None) -> dict:
+        message = {
+            'message_id': self._next_message_id(), 'date': int(time.time()),
+            'chat': {'id': user, 'type': 'private'}, 'from': {'id': user, 'is_bot': False, 'first_name': str(user)},
+            'photo': [{'file_id': str(screenshot), 'file_unique_id': str(screenshot), 'width': 1080, 'height': 2400}]
+        }
+        if media_group is not None:
+            message['media_group_id'] = media_group
+        return {'update_id': len(self._updates) + 1, 'message': message}
+
+    def add_text(self, user: int, text: str):
+        """Queues a text message from ``user`` to go out with the burst, marked as a command if it is one."""
+        message = {
+            'message_id': self._next_message_id(), 'date': int(time.time()),
+            'chat': {'id': user, 'type': 'private'}, 'from': {'id': user, 'is_bot': False, 'first_name': str(user)},
+            'text': text
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        self._updates.append({'update_id': len(self._updates) + 1, 'message': message})
+
+    def release(self):
+        self.started = time.monotonic()
+        self._released.set()
+        if self._webhook is not None:
+            self._post_updates(self._webhook)
+
+    def _post_update(self, webhook: dict, update: dict):
+        request = urllib.request.Request(webhook['url'], data=json.dumps(update).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        if webhook.get('secret_token'):
+            request.add_header('X-Telegram-Bot-Api-Secret-Token', webhook['secret_token'])
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except OSError as e:
+            print(f"Couldn't post update {update['update_id']} to {webhook['url']}: {e}")
+            status = 'failed'
+        with self._lock:
+            self.stats[f'webhook {status}'] += 1
+
+    def _post_updates(self, webhook: dict):
+        """Posts every update to the webhook, over as many connections at once as the bot asked for."""
+        if self._posted:
+            return
+        self._posted = True
+        executor = ThreadPoolExecutor(int(webhook.get('max_connections', 40)))
+        for update in self._updates:
+            executor.submit(self._post_update, webhook, update)
+        executor.shutdown(wait=False)
+
+    def set_webhook(self, params: dict):
+        self._webhook = params if params.get('url') else None
+        if self._webhook is not None and self._released.is_set():
+            self._post_updates(self._webhook)
+
+    def get_updates(self, params: dict) -> list:
+        offset, timeout = int(params.get('offset', 0) or 0), float(params.get('timeout', 0) or 0)
+        if not self._released.wait(timeout):
+            return []
+        updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not updates:
+            time.sleep(timeout)
+        return updates
+
+    def send(self, method: str, params: dict) -> Tuple[int, dict]:
+        chat_id = int(params.get('chat_id', 0))
+        now = time.monotonic()
+        with self._lock:
+            retry_after = max(self._global.retry_after(now), self._chats[chat_id].retry_after(now))
+            if retry_after:
+                self.stats['429'] += 1
+                return 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after '
+                             f'{retry_after}', 'parameters': {'retry_after': retry_after}}
+            self._global.add(now)
+            self._chats[chat_id].add(now)
+            self.stats[method] += 1
+            self.replies[chat_id].append(now - self.started)
+            self.texts[chat_id].append(params.get('text', ''))
+            message_id = self._next_message_id()
+
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'bot'}, 'text': params.get('text', '')
+        }}
+
+    def call(self, method: str, params: dict) -> Tuple[int, dict]:
+        if method in _SEND_METHODS:
+            return self.send(method, params)
+
+        with self._lock:
+            self.stats[method] += 1
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'stub_bot'}
+        elif method == 'getUpdates':
+            result = self.get_updates(params)
+        elif method == 'setWebhook':
+            self.set_webhook(params)
+            result = True
+        elif method == 'deleteWebhook':
+            self._webhook = None
+            result = True
+        elif method == 'getFile':
+            result = {'file_id': params['file_id'], 'file_unique_id': params['file_id'],
+                      'file_path': f"photos/{params['file_id']}"}
+        else:
+            # deleteMessage, answerCallbackQuery and the like
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        print(f'{elapsed:.1f}s since the burst')
+        for method, count in sorted(self.stats.items()):
+            print(f'{method:<22} {count:>6}')
+        for chat_id, replies in sorted(self.replies.items()):
+            print(f'chat {chat_id:<12} {len(replies):>4} replies, first after {replies[0]:.2f}s, '
+                  f'last after {replies[-1]:.2f}s')
+
+
+def _handler(api: StubBotApi):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: bytes, content_type: str = 'application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts[0] == 'file' and parts[-2] == 'photos':
+                index = int(parts[-1])
+                self._reply(200, api.screenshots[index].read_bytes(), 'application/octet-stream')
+            else:
+                self.do_POST()
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0) or 0))
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                params = json.loads(body or b'{}')
+            elif content_type.startswith('application/x-www-form-urlencoded'):
+                params = dict(parse_qsl(body.decode()))
+            else:
+                params = dict()
+
+            status, response = api.call(self.path.rsplit('/', 1)[-1], params)
+            self._reply(status, json.dumps(response).encode())
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('screenshots', type=pathlib.Path, help='Directory of screenshots the users send')
+    parser.add_argument('--users', default='42', help='Comma-separated Telegram user IDs that send screenshots')
+    parser.add_argument('--burst', type=int, default=3, help='Screenshots each user sends at once')
+    parser.add_argument('--album', action='store_true', help="Send each user's burst as an album")
+    parser.add_argument('--delay', type=float, default=5, help='Seconds to wait for the bot before the burst')
+    parser.add_argument('--rate', type=int, default=30, help='Messages a second allowed overall')
+    parser.add_argument('--chat-rate', type=int, default=1, help='Messages a second allowed to one chat')
+    parser.add_argument('--duration', type=float, help='Seconds to run for before reporting (default: until Ctrl+C)')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    screenshots = sorted(p for p in args.screenshots.iterdir() if p.suffix.lower() in _IMAGE_SUFFIXES)
+    if not screenshots:
+        parser.error(f'No screenshots in {args.screenshots}')
+
+    api = StubBotApi(screenshots, [int(u) for u in args.users.split(',')], args.burst, args.album,
+                     args.rate, args.chat_rate)
+    server = ThreadingHTTPServer(('localhost', args.port), _handler(api))
+    server.daemon_threads = True
+    threading.Timer(args.delay, api.release).start()
+    if args.duration:
+        threading.Timer(args.duration, server.shutdown).start()
+    print(f'Listening on http://localhost:{args.port}, the burst is sent in {args.delay}s')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        api.report()
+
+
+if __name__ == '__main__':
+    main()
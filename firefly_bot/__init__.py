@@ -1,55 +1,117 @@
 import logging
-import os
+from typing import Union
 
 import i18n
 from telegram import Update
-from telegram.ext import (CallbackContext, CommandHandler, Updater)
+from telegram.ext import Application, CallbackContext, CommandHandler
 
+from firefly_bot.balance import album_handler as balance_album_handler
 from firefly_bot.balance import conv_handler as balance_conv_handler
-from firefly_bot.config import config
+from firefly_bot.config import config, init_config
+from firefly_bot.firefly import close_api_client, refresh_account_cache
 from firefly_bot.manage import conv_handler as manage_conv_handler
+from firefly_bot.metrics import start_metrics_server
+from firefly_bot.outbox import close_outbox, reply_markdown
 from firefly_bot.setup import conv_handler as setup_conv_handler
-from firefly_bot.utils import _write_user_file
+from firefly_bot.utils import _user_exists, _write_user_file
+from firefly_bot.workers import get_worker_pool
 
 logger = logging.getLogger(__name__)
 
 
-def start(update: Update, _: CallbackContext):
+async def start(update: Update, _: CallbackContext):
     if update.effective_user.id not in config.get('bot').get('users'):
         return
 
-    user_file = os.path.join(config.get('bot').get('storage').get('path'), f'{update.message.from_user.id}.json')
-    if not os.path.exists(user_file):
+    if not _user_exists(update.effective_user.id):
         _write_user_file(update.effective_user.id, dict())
 
-        update.message.reply_markdown(i18n.t('general.welcome') + i18n.t('general.help'))
+        reply_markdown(update.message, i18n.t('general.welcome') + i18n.t('general.help'))
         logger.info(f'New user {update.message.from_user.name}:{update.message.from_user.id} created')
 
 
-def info(update: Update, _: CallbackContext):
+async def info(update: Update, _: CallbackContext):
     if update.effective_user.id not in config.get('bot').get('users'):
         return
 
-    update.message.reply_markdown(i18n.t('general.help'))
+    reply_markdown(update.message, i18n.t('general.help'))
     logger.info(f'User {update.message.from_user.name}:{update.message.from_user.id} used help command')
 
 
-def main() -> None:
-    updater = Updater(config.get('telegram').get('token'))
-    dispatcher = updater.dispatcher
+def _get_webhook_options() -> dict:
+    """The arguments to listen for webhook updates with, as set up in the config."""
+    telegram = config.get('telegram')
+    webhook = telegram.get('webhook', dict())
+    # Without a public URL, Telegram would be told to post updates to the address the bot listens on
+    if not webhook.get('url'):
+        raise ValueError('telegram.webhook.url (TELEGRAM_WEBHOOK_URL) must be set to use webhook mode')
+
+    url_path = webhook.get('path') or telegram.get('token')
+    return dict(
+        listen=webhook.get('listen', '0.0.0.0'),
+        port=int(webhook.get('port', 8443)),
+        url_path=url_path,
+        webhook_url=f"{webhook.get('url').rstrip('/')}/{url_path}"
+    )
+
+
+def _run(application: Application, webhook: Union[dict, None]):
+    """Takes updates, by webhook given its options or by long polling otherwise, until the bot is stopped."""
+    if webhook is not None:
+        logger.info(f"Receiving updates by webhook on {webhook.get('listen')}:{webhook.get('port')}")
+        application.run_webhook(**webhook)
+    else:
+        logger.info('Receiving updates by long polling')
+        application.run_polling()
+
+
+async def _start_workers(_: CallbackContext):
+    # Worker processes start, and optionally load Tesseract, while the bot is already taking updates
+    get_worker_pool().start()
+
+
+def _build_application() -> Application:
+    telegram = config.get('telegram')
+    # Updates are processed one at a time as ConversationHandler requires, the screenshot handlers
+    # are non-blocking so their downloads, OCR and Firefly calls still overlap
+    builder = Application.builder().token(telegram.get('token'))
+    # Replies still queued in the outbox are sent before the bot disconnects
+    builder.post_stop(close_outbox)
+    if telegram.get('base_url'):
+        builder.base_url(telegram.get('base_url'))
+    if telegram.get('base_file_url'):
+        builder.base_file_url(telegram.get('base_file_url'))
+    application = builder.build()
 
     start_handler = CommandHandler('start', start)
     help_handler = CommandHandler('help', info)
 
     # Ordering is important here!
-    dispatcher.add_handler(manage_conv_handler)
-    dispatcher.add_handler(setup_conv_handler)
-    dispatcher.add_handler(balance_conv_handler)
-    dispatcher.add_handler(start_handler)
-    dispatcher.add_handler(help_handler)
-
-    updater.start_polling()
-    updater.idle()
+    application.add_handler(manage_conv_handler)
+    application.add_handler(setup_conv_handler)
+    application.add_handler(balance_conv_handler)
+    application.add_handler(balance_album_handler)
+    application.add_handler(start_handler)
+    application.add_handler(help_handler)
+
+    # Warms the asset account cache straight away, then keeps it fresh in the background
+    application.job_queue.run_repeating(
+        refresh_account_cache, interval=config.get('bot').get('firefly', dict()).get('cache_ttl', 300), first=0
+    )
+    application.job_queue.run_once(_start_workers, 0)
+
+    return application
+
+
+def main() -> None:
+    init_config()
+    webhook = _get_webhook_options() if config.get('telegram').get('mode', 'polling') == 'webhook' else None
+    application = _build_application()
+
+    start_metrics_server()
+    _run(application, webhook)
+    get_worker_pool().shutdown()
+    close_api_client()
 
 
 if __name__ == '__main__':
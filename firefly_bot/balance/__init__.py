@@ -1,13 +1,23 @@
-from telegram.ext import CallbackQueryHandler, ConversationHandler, Filters, MessageHandler
+from telegram.ext import CallbackQueryHandler, ConversationHandler, MessageHandler
+# Imported by name, this package's own filters module shadows telegram.ext.filters
+from telegram.ext.filters import PHOTO, TEXT
 
 from firefly_bot.balance import commands
+from firefly_bot.balance.filters import media_group
 
 conv_handler = ConversationHandler(
-    entry_points=[MessageHandler(Filters.photo, commands.update_balance_from_image)],
+    entry_points=[MessageHandler(PHOTO & ~media_group, commands.update_balance_from_image, block=False)],
     states={
-        commands.ACCOUNT: [CallbackQueryHandler(commands.choose_account_to_update)],
-        ConversationHandler.TIMEOUT: [MessageHandler(Filters.text, commands.timeout)]
+        commands.ACCOUNT: [CallbackQueryHandler(commands.choose_account_to_update, block=False)],
+        # A screenshot sent while the last one is still being processed
+        ConversationHandler.WAITING: [
+            MessageHandler(PHOTO & ~media_group, commands.update_balance_while_busy, block=False)
+        ],
+        ConversationHandler.TIMEOUT: [MessageHandler(TEXT, commands.timeout)]
     },
     fallbacks=[],
     conversation_timeout=120
 )
+
+# Photos sent as an album are collected outside of the conversation and processed together
+album_handler = MessageHandler(PHOTO & media_group, commands.collect_album_photo)
@@ -1,21 +1,32 @@
+import asyncio
 import datetime
 import logging
 from collections import defaultdict
-from io import BytesIO
-from typing import Union
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Union
 
 import firefly_iii_client
 import i18n
-from firefly_iii_client.api import accounts_api, transactions_api
 from firefly_iii_client.model.transaction_split_store import TransactionSplitStore
 from firefly_iii_client.model.transaction_store import TransactionStore
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, PhotoSize, Update
 from telegram.ext import CallbackContext, ConversationHandler
-
-from firefly_bot.balance.data import BalanceUpdate
-from firefly_bot.config import config, ff_configuration
-from firefly_bot.utils import _get_nearest_balance_from_screenshot, _get_similar_accounts_from_screenshot, \
-    _get_user_file
+from telegram.helpers import escape_markdown
+from urllib3.exceptions import HTTPError
+
+from firefly_bot.balance.data import Album, BalanceUpdate
+from firefly_bot.config import config
+from firefly_bot.data import ScreenshotResult
+from firefly_bot.firefly import get_account_cache, run_in_executor, store_transaction
+from firefly_bot.metrics import instrumented
+from firefly_bot.outbox import delete, reply_markdown, reply_text
+from firefly_bot.utils import _await_similar_accounts_from_screenshot, _download_screenshot, \
+    _get_screenshot_digest, _get_screenshot_result, _get_thumbnail, _get_user_accounts, _get_user_templates, \
+    _put_screenshot_result
+from firefly_bot.workers import WorkerPoolFull, get_worker_pool, run_in_worker
+
+if TYPE_CHECKING:
+    from imagehash import ImageHash
 
 logger = logging.getLogger(__name__)
 
@@ -23,91 +34,163 @@ logger = logging.getLogger(__name__)
 ACCOUNT, = range(1)
 
 
+def _balance_adjustment(account_id: int, balance_difference: float, date: datetime.datetime) -> TransactionStore:
+    return TransactionStore(
+        transactions=[
+            TransactionSplitStore(
+                amount=str(abs(balance_difference)),
+                date=date,
+                description=config.get('bot').get('balance').get('description'),
+                destination_id=None if balance_difference < 0 else str(account_id),
+                destination_name='(bot balance adjustment)' if balance_difference < 0 else None,
+                source_id=str(account_id) if balance_difference < 0 else None,
+                source_name=None if balance_difference < 0 else '(bot balance adjustment)',
+                type="withdrawal" if balance_difference < 0 else "deposit"
+            )
+        ]
+    )
+
+
 def _update_firefly_balance(account_id: int, balance: float) -> float:
-    with firefly_iii_client.ApiClient(ff_configuration) as api_client:
-        accounts_instance = accounts_api.AccountsApi(api_client)
-        transactions_instance = transactions_api.TransactionsApi(api_client)
+    account_cache = get_account_cache()
+    account_record = account_cache.get(account_id)
 
-        account_record = accounts_instance.get_account(account_id).data
+    balance_difference = round(
+        balance - float(account_record.attributes.current_balance), 2
+    )
 
+    if abs(balance_difference) > 0:
+        # The cached balance may be out of date, so re-read it before writing an adjustment
+        account_record = account_cache.get(account_id, fresh=True)
         balance_difference = round(
             balance - float(account_record.attributes.current_balance), 2
         )
 
-        if abs(balance_difference) > 0:
-            transaction_store = TransactionStore(
-                transactions=[
-                    TransactionSplitStore(
-                        amount=str(abs(balance_difference)),
-                        date=datetime.datetime.now(),
-                        description=config.get('bot').get('balance').get('description'),
-                        destination_id=None if balance_difference < 0 else str(account_id),
-                        destination_name='(bot balance adjustment)' if balance_difference < 0 else None,
-                        source_id=str(account_id) if balance_difference < 0 else None,
-                        source_name=None if balance_difference < 0 else '(bot balance adjustment)',
-                        type="withdrawal" if balance_difference < 0 else "deposit"
-                    )
-                ]
-            )
+    if abs(balance_difference) > 0:
+        try:
+            store_transaction(_balance_adjustment(account_id, balance_difference, datetime.datetime.now()))
+        except TypeError as e:
+            # Issue with transaction API ?
+            logger.error(e)
+        account_cache.set_balance(account_id, balance)
+        logger.info(f"Updated balance of account "
+                    f"{account_record.id}:{account_record.attributes.name}")
+    else:
+        logger.info(f"Balance has remained the same for account "
+                    f"{account_record.id}:{account_record.attributes.name}")
 
-            try:
-                transactions_instance.store_transaction(transaction_store)
-            except TypeError as e:
-                # Issue with transaction API ?
-                logger.error(e)
-            logger.info(f"Updated balance of account "
-                        f"{account_record.id}:{account_record.attributes.name}")
-        else:
-            logger.info(f"Balance has remained the same for account "
-                        f"{account_record.id}:{account_record.attributes.name}")
+    return balance_difference
 
-        return balance_difference
 
+async def _read_balances(update: Union[Update, None], balance_update: BalanceUpdate):
+    """OCRs the balances of the matched accounts that haven't already been found in this screenshot."""
+    result = balance_update.result
+    # Balances already found in this screenshot, e.g. when it has been sent before, don't need OCR again
+    unread = [account for account in balance_update.sim_accounts if account.get('id') not in result.balances]
+    if unread:
+        if balance_update.screenshot is None:
+            balance_update.screenshot = await _download_screenshot(balance_update.photo)
+
+        balances = await run_in_worker(
+            update, '_get_nearest_balances_from_screenshot',
+            balance_update.screenshot, [account.get('image') for account in unread]
+        )
+        result.balances.update((account.get('id'), balance)
+                               for account, balance in zip(unread, balances) if balance is not None)
+
+
+async def _apply_balances(balance_updates: List[BalanceUpdate]) -> str:
+    """Writes the balances read from screenshots to Firefly and returns a summary line for every account.
+
+    An account matched by more than one of the screenshots is only updated from the first of them.
+    """
+    # Every account's Firefly round-trips run concurrently, results are collected in account order
+    updates = []
+    seen = set()
+    for balance_update in balance_updates:
+        result = balance_update.result
+        for account in balance_update.sim_accounts:
+            balance = result.balances.get(account.get('id'))
+            duplicate = account.get('id') in seen
+            if balance is None or account.get('id') in result.applied or duplicate:
+                updates.append((result, account, None, duplicate))
+            else:
+                seen.add(account.get('id'))
+                updates.append((result, account, run_in_executor(
+                    _update_firefly_balance, int(account.get('id')), float(balance.price.amount)
+                ), duplicate))
 
-def _update_firefly_balances_in_relationship(update: Update, context: CallbackContext) -> int:
-    balance_update = context.user_data.get('update')
     account_str = ''
-    for account in balance_update.sim_accounts:
+    for result, account, future, duplicate in updates:
         logger.info(f"Detected screenshot as balance of account "
                     f"{account.get('id')}:{account.get('name')}")
-        balance_update.screenshot.seek(0)
-        balance = _get_nearest_balance_from_screenshot(
-            balance_update.screenshot, account.get('image').get('x'), account.get('image').get('y')
-        )
 
-        balance_difference = _update_firefly_balance(int(account.get('id')), float(balance.price.amount))
+        if duplicate:
+            logger.info(f"Account {account.get('id')}:{account.get('name')} was already updated from another "
+                        f"screenshot")
+            account_str += i18n.t('balance.account_duplicate', name=account.get('name')) + '\n'
+            continue
+        elif account.get('id') in result.applied:
+            logger.info(f"Screenshot was already applied to account {account.get('id')}:{account.get('name')}")
+            account_str += i18n.t('balance.account_applied', name=account.get('name')) + '\n'
+            continue
+        elif future is None:
+            logger.warning(f"Found NO balance for account {account.get('id')}:{account.get('name')}")
+            account_str += i18n.t('balance.account_not_found', name=account.get('name')) + '\n'
+            continue
+
+        try:
+            balance_difference = await future
+        except (firefly_iii_client.ApiException, HTTPError) as e:
+            logger.error(f"Failed updating balance of account {account.get('id')}:{account.get('name')}: {e}")
+            reason = e.reason if isinstance(e, firefly_iii_client.ApiException) else e
+            account_str += i18n.t('balance.account_failed', name=account.get('name'), reason=reason) + '\n'
+            continue
+
+        result.applied.add(account.get('id'))
+
         emoji = '📈' if balance_difference > 0 else '📉' if balance_difference < 0 else '⚖'
         account_str += f' - {emoji} {account.get("name")} ' \
                        f'({"+" if balance_difference > 0 else ""}' \
                        f'{balance_difference if balance_difference != 0 else "unchanged"})\n'
+    return account_str
+
+
+async def _update_balances(update: Update, balance_update: BalanceUpdate):
+    await _read_balances(update, balance_update)
+    account_str = await _apply_balances([balance_update])
 
     logger.info(f'User {update.effective_user.name}:{update.effective_user.id} '
                 f'updated balance of {len(balance_update.sim_accounts)} accounts')
-    update.effective_message.reply_markdown(
+    reply_markdown(
+        update.effective_message,
         i18n.t('balance.balance_updated',
                accounts=account_str,
                count=len(balance_update.sim_accounts)))
-    balance_update.screenshot.close()
+
+
+async def _update_firefly_balances_in_relationship(update: Update, context: CallbackContext) -> int:
+    await _update_balances(update, context.user_data.get('update'))
     del context.user_data['update']
     return ConversationHandler.END
 
 
-def choose_account_to_update(update: Update, context: CallbackContext) -> int:
+@instrumented()
+async def choose_account_to_update(update: Update, context: CallbackContext) -> int:
     balance_update = context.user_data.get('update')
     query = update.callback_query
-    query.answer()
+    await query.answer()
 
     if query.data == "no":
-        balance_update.screenshot.close()
-        update.effective_message.reply_text(i18n.t('balance.screenshot_unknown'))
+        reply_text(update.effective_message, i18n.t('balance.screenshot_unknown'))
     else:
         balance_update.sim_accounts = [account for account in balance_update.accounts
                                        if account.get('relationship') == int(query.data)]
         try:
-            return _update_firefly_balances_in_relationship(update, context)
-        except firefly_iii_client.ApiException as e:
-            logger.error(e)
-            update.effective_message.reply_text(i18n.t('general.firefly_no_connect', reason=e.reason))
+            return await _update_firefly_balances_in_relationship(update, context)
+        except WorkerPoolFull:
+            logger.warning('Worker pool is full, rejected balance update')
+            reply_text(update.effective_message, i18n.t('general.busy'))
 
         logger.info(f'User {update.effective_user.name}:{update.effective_user.id} chose to '
                     f'update balance for accounts in relationship {query.data}')
@@ -115,43 +198,85 @@ def choose_account_to_update(update: Update, context: CallbackContext) -> int:
     return ConversationHandler.END
 
 
-def update_balance_from_image(update: Update, context: CallbackContext) -> Union[None, int]:
-    user = _get_user_file(update.message.from_user.id)
-
-    if 'accounts' not in user:
-        return None
+async def _get_screenshot_hash_for_update(update: Union[Update, None], balance_update: BalanceUpdate,
+                                          algorithm: str) -> 'ImageHash':
+    """Hashes the screenshot's small rendition with one algorithm of the cascade, at most once per screenshot."""
+    hashes = balance_update.result.image_hashes
+    if algorithm not in hashes:
+        if balance_update.thumbnail is None:
+            balance_update.thumbnail = await _download_screenshot(balance_update.thumbnail_size)
+        hashes[algorithm] = await run_in_worker(update, '_get_screenshot_hash', balance_update.thumbnail, algorithm)
+    return hashes[algorithm]
 
-    update.message.delete()
 
+async def _match_screenshot(update: Union[Update, None], user_id: int, photo: List[PhotoSize],
+                            accounts: Dict[str, dict]) -> BalanceUpdate:
+    """Works out which of the user's accounts a screenshot is of. Raises :class:`WorkerPoolFull`."""
     balance_update = BalanceUpdate()
-    context.user_data['update'] = balance_update
-
-    logger.info(f'User {update.message.from_user.name}:{update.message.from_user.id} '
-                f'submitted screenshot for new balance')
-
-    b = BytesIO()
-    screenshot_file = update.message.photo[-1].get_file()
-    screenshot_file.download(out=b)
+    balance_update.photo = photo[-1]
+    balance_update.accounts = list(accounts.values())
+
+    # A resent screenshot is recognised by Telegram's file id before downloading anything, or by its contents
+    # Only a small rendition is needed to tell which account this is, the full size one is fetched for OCR
+    balance_update.thumbnail_size = _get_thumbnail(photo)
+    balance_update.result = _get_screenshot_result(user_id, balance_update.photo.file_unique_id)
+    if balance_update.result is None:
+        balance_update.thumbnail = await _download_screenshot(balance_update.thumbnail_size)
+        if balance_update.thumbnail_size.file_unique_id == balance_update.photo.file_unique_id:
+            balance_update.screenshot = balance_update.thumbnail
+
+        digest = _get_screenshot_digest(balance_update.thumbnail)
+        balance_update.result = _get_screenshot_result(user_id, digest) or ScreenshotResult()
+        _put_screenshot_result(user_id, balance_update.result, balance_update.photo.file_unique_id, digest)
+    else:
+        logger.info(f'Screenshot {balance_update.photo.file_unique_id} has been seen before')
 
-    balance_update.accounts = list(user.get('accounts').values())
-    balance_update.screenshot = b
-    balance_update.sim_accounts = _get_similar_accounts_from_screenshot(
-        balance_update.screenshot,
-        balance_update.accounts
+    matches = await _await_similar_accounts_from_screenshot(
+        partial(_get_screenshot_hash_for_update, update, balance_update),
+        _get_user_templates(user_id)
     )
+    balance_update.sim_accounts = [m.account for m in matches]
+
+    if matches:
+        logger.info(f'Screenshot matched {len(matches)} accounts with hash distance {matches[0].distance}')
+    return balance_update
 
-    balance_update.screenshot.seek(0)
 
-    if balance_update.sim_accounts and \
+def _is_unambiguous(balance_update: BalanceUpdate) -> bool:
+    """Whether the screenshot matched accounts that are all in the same relationship."""
+    return bool(balance_update.sim_accounts) and \
         all(balance_update.sim_accounts[0].get('relationship')
-            == acc.get('relationship') for acc in balance_update.sim_accounts):
+            == acc.get('relationship') for acc in balance_update.sim_accounts)
+
+
+@instrumented()
+async def update_balance_from_image(update: Update, context: CallbackContext) -> Union[None, int]:
+    accounts = _get_user_accounts(update.message.from_user.id)
+
+    if not accounts:
+        return None
+
+    delete(update.message)
+
+    logger.info(f'User {update.message.from_user.name}:{update.message.from_user.id} '
+                f'submitted screenshot for new balance')
+
+    try:
+        balance_update = await _match_screenshot(update, update.message.from_user.id, update.message.photo,
+                                                 accounts)
+    except WorkerPoolFull:
+        logger.warning('Worker pool is full, rejected balance update')
+        reply_text(update.message, i18n.t('general.busy'))
+        return ConversationHandler.END
+    context.user_data['update'] = balance_update
+
+    if _is_unambiguous(balance_update):
         try:
-            return _update_firefly_balances_in_relationship(update, context)
-        except firefly_iii_client.ApiException as e:
-            logger.error(e)
-            update.message.reply_text(i18n.t('general.firefly_no_connect', reason=e.reason))
+            return await _update_firefly_balances_in_relationship(update, context)
+        except WorkerPoolFull:
+            logger.warning('Worker pool is full, rejected balance update')
+            reply_text(update.message, i18n.t('general.busy'))
 
-        balance_update.screenshot.close()
         del context.user_data['update']
         return ConversationHandler.END
     elif len(balance_update.sim_accounts):
@@ -166,17 +291,137 @@ def update_balance_from_image(update: Update, context: CallbackContext) -> Union
             [InlineKeyboardButton(text=i18n.t('general.collection_none'), callback_data='no')]
         )
 
-        update.message.reply_text(i18n.t('balance.screenshot_conflict'),
-                                  reply_markup=InlineKeyboardMarkup(keyboard))
+        reply_text(update.message, i18n.t('balance.screenshot_conflict'),
+                   reply_markup=InlineKeyboardMarkup(keyboard))
         return ACCOUNT
     else:
-        update.message.reply_text(i18n.t('balance.screenshot_unknown'))
-        balance_update.screenshot.close()
+        reply_text(update.message, i18n.t('balance.screenshot_unknown'))
         del context.user_data['update']
         return ConversationHandler.END
 
 
-def timeout(update: Update, context: CallbackContext):
+@instrumented()
+async def update_balance_while_busy(update: Update, _: CallbackContext):
+    """Handles a screenshot sent while the previous one is still being processed, outside of the conversation.
+
+    Screenshots that need the user to choose an account can't be asked about until the conversation is free.
+    """
+    accounts = _get_user_accounts(update.message.from_user.id)
+    if not accounts:
+        return
+
+    delete(update.message)
+
+    logger.info(f'User {update.message.from_user.name}:{update.message.from_user.id} '
+                f'submitted screenshot for new balance while the last one is processing')
+
+    try:
+        balance_update = await _match_screenshot(update, update.message.from_user.id, update.message.photo,
+                                                 accounts)
+        if _is_unambiguous(balance_update):
+            await _update_balances(update, balance_update)
+            return
+    except WorkerPoolFull:
+        logger.warning('Worker pool is full, rejected balance update')
+        reply_text(update.message, i18n.t('general.busy'))
+        return
+
+    if balance_update.sim_accounts:
+        names = ', '.join(acc.get('name') for acc in balance_update.sim_accounts)
+        reply_text(update.message, i18n.t('balance.screenshot_conflict_busy', names=names))
+    else:
+        reply_text(update.message, i18n.t('balance.screenshot_unknown'))
+
+
+@instrumented()
+async def collect_album_photo(update: Update, context: CallbackContext):
+    """Collects the photos of an album, which are all processed together once the collection window closes."""
+    if not _get_user_accounts(update.message.from_user.id):
+        return
+
+    delete(update.message)
+
+    albums = context.user_data.setdefault('albums', dict())
+    album = albums.get(update.message.media_group_id)
+    if album is None:
+        album = Album(update.message.media_group_id)
+        albums[album.media_group_id] = album
+        window = float(config.get('bot').get('balance').get('album_window', 2))
+        context.job_queue.run_once(_close_album, window, data=(albums, album))
+        logger.info(f'User {update.message.from_user.name}:{update.message.from_user.id} '
+                    f'started sending album {album.media_group_id}')
+    album.updates.append(update)
+
+
+async def _close_album(context: CallbackContext):
+    albums, album = context.job.data
+    del albums[album.media_group_id]
+    # The job only hands the album over, processing it runs as a task like any other handler
+    context.application.create_task(update_balances_from_album(album), update=album.updates[0])
+
+
+async def _read_album_photo(parallel: asyncio.Semaphore, user_id: int, photo: List[PhotoSize],
+                            accounts: Dict[str, dict]) -> BalanceUpdate:
+    async with parallel:
+        balance_update = await _match_screenshot(None, user_id, photo, accounts)
+        if _is_unambiguous(balance_update):
+            await _read_balances(None, balance_update)
+        return balance_update
+
+
+@instrumented()
+async def update_balances_from_album(album: Album):
+    """Matches and OCRs every screenshot of an album in parallel and replies with one summary of them all."""
+    first = album.updates[0]
+    user_id = first.effective_user.id
+    accounts = _get_user_accounts(user_id)
+    logger.info(f'User {first.effective_user.name}:{user_id} submitted album {album.media_group_id} '
+                f'of {len(album.updates)} screenshots for new balances')
+
+    # No more screenshots than the worker pool can take at once, so the album doesn't turn itself away
+    pool = get_worker_pool()
+    parallel = asyncio.Semaphore(max(pool.capacity - pool.pending, 1))
+    results = await asyncio.gather(*(_read_album_photo(parallel, user_id, u.message.photo, accounts)
+                                     for u in album.updates), return_exceptions=True)
+
+    balance_updates = []
+    skipped_str = ''
+    for i, balance_update in enumerate(results, start=1):
+        if isinstance(balance_update, WorkerPoolFull):
+            logger.warning(f'Worker pool is full, rejected screenshot {i} of album {album.media_group_id}')
+            skipped_str += i18n.t('balance.album_screenshot_busy', index=i) + '\n'
+            continue
+        elif isinstance(balance_update, Exception):
+            # A download that timed out or a photo that couldn't be decoded or OCR'd, the rest still count
+            logger.error(f'Failed reading screenshot {i} of album {album.media_group_id}: {balance_update!r}')
+            reason = escape_markdown(str(balance_update) or type(balance_update).__name__)
+            skipped_str += i18n.t('balance.album_screenshot_failed', index=i, reason=reason) + '\n'
+            continue
+        elif isinstance(balance_update, BaseException):
+            raise balance_update
+
+        if _is_unambiguous(balance_update):
+            balance_updates.append(balance_update)
+        elif balance_update.sim_accounts:
+            names = ', '.join(acc.get('name') for acc in balance_update.sim_accounts)
+            skipped_str += i18n.t('balance.album_screenshot_conflict', index=i, names=names) + '\n'
+        else:
+            skipped_str += i18n.t('balance.album_screenshot_unknown', index=i) + '\n'
+
+    account_str = await _apply_balances(balance_updates)
+    count = len({acc.get('id') for balance_update in balance_updates for acc in balance_update.sim_accounts})
+    logger.info(f'User {first.effective_user.name}:{user_id} updated balance of {count} accounts '
+                f'from album {album.media_group_id}')
+    reply_markdown(
+        first.effective_message,
+        i18n.t('balance.album_updated',
+               accounts=account_str + skipped_str,
+               count=count,
+               screenshots=len(album.updates)))
+
+
+@instrumented()
+async def timeout(update: Update, context: CallbackContext):
     del context.user_data['update']
     logger.info(f'{update.message.from_user.name}:{update.message.from_user.id} timed out balance update')
     return ConversationHandler.END
@@ -1,11 +1,28 @@
-from dataclasses import dataclass
-from io import IOBase
+from dataclasses import dataclass, field
 from typing import Dict, List
 
+from telegram import PhotoSize, Update
+
+from firefly_bot.data import ScreenshotResult
+from firefly_bot.screenshot import Screenshot
+
 
 @dataclass
 class BalanceUpdate:
-    screenshot: IOBase = None
+    photo: PhotoSize = None
+    # Small rendition the screenshot is hashed from, only downloaded once a hash has to be computed
+    thumbnail_size: PhotoSize = None
+    thumbnail: Screenshot = None
+    # Full size screenshot, only downloaded once it's needed for OCR
+    screenshot: Screenshot = None
+    result: ScreenshotResult = None
 
     accounts: List[Dict] = None
     sim_accounts: List[Dict] = None
+
+
+@dataclass
+class Album:
+    """Screenshots sent together as one Telegram album, collected until they are processed as a batch."""
+    media_group_id: str
+    updates: List[Update] = field(default_factory=list)
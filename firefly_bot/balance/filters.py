@@ -0,0 +1,13 @@
+from telegram import Message
+from telegram.ext.filters import MessageFilter
+
+
+class _MediaGroupFilter(MessageFilter):
+    """Messages that are part of an album."""
+    name = 'media_group'
+
+    def filter(self, message: Message) -> bool:
+        return message.media_group_id is not None
+
+
+media_group = _MediaGroupFilter()
@@ -2,27 +2,22 @@ import logging
 import os
 import pathlib
 
-import firefly_iii_client
 import i18n
 import yaml
 
-with open('./config.yml', 'r') as f:
-    config = yaml.load(f, Loader=yaml.FullLoader)
+# Filled in by init_config, every entry point calls it before anything reads the config
+config = dict()
 
-i18n.load_path.append(os.path.join(pathlib.Path(__file__).parent.resolve(), '../locale'))
 
-logging.basicConfig(**config.get('bot').get('logging'))
+def init_config(path: str = './config.yml') -> dict:
+    """Loads config.yml, the locale files and the logging setup, once per process."""
+    if config:
+        return config
 
-ff = config.get('firefly')
+    with open(path, 'r') as f:
+        config.update(yaml.load(f, Loader=yaml.FullLoader))
 
-if ff.get('access_token_file'):
-    with open(ff.get('access_token_file'), 'r') as f:
-        token = f.read()
-    
-    ff['access_token'] = token
+    i18n.load_path.append(os.path.join(pathlib.Path(__file__).parent.resolve(), '../locale'))
 
-ff.pop('access_token_file')
-
-ff_configuration = firefly_iii_client.Configuration(
-    **ff
-)
+    logging.basicConfig(**config.get('bot').get('logging'))
+    return config
@@ -1,11 +1,43 @@
-from dataclasses import dataclass
-from typing import Union
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, List, Set, Union
 
-from price_parser import Price
+if TYPE_CHECKING:
+    from imagehash import ImageHash
+    from price_parser import Price
 
 
 @dataclass
 class Balance:
     x: int
     y: int
-    price: Union[Price, None] = None
+    price: Union['Price', None] = None
+    # Tesseract's confidence in the text the price was read from, the lowest one if it was split over words
+    conf: Union[float, None] = None
+
+
+@dataclass
+class AccountMatch:
+    account: Dict
+    distance: int
+
+
+@dataclass
+class ScreenshotResult:
+    """What has already been worked out from a screenshot, so a resent copy can skip the work."""
+    # Screenshot hashes computed so far for each algorithm of the hash cascade
+    image_hashes: Dict[str, 'ImageHash'] = field(default_factory=dict)
+    # Balances found for each account id
+    balances: Dict[int, Balance] = field(default_factory=dict)
+    # Ids of the accounts whose balance was already updated from this screenshot
+    applied: Set[int] = field(default_factory=set)
+
+
+@dataclass
+class LibraryTemplate:
+    """A known app layout in the shared template library."""
+    algorithm: str
+    hash: List[List[bool]]
+    # Balance location as fractions of the screenshot width and height
+    x: float
+    y: float
+    app: Union[str, None] = None
@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Union
+
+import firefly_iii_client
+from firefly_iii_client.api import accounts_api, transactions_api
+from firefly_iii_client.model.account_read import AccountRead
+from firefly_iii_client.model.account_type_filter import AccountTypeFilter
+from firefly_iii_client.model.transaction_store import TransactionStore
+from telegram.ext import CallbackContext
+from urllib3 import Retry
+from urllib3.exceptions import HTTPError
+
+from firefly_bot.config import config
+from firefly_bot.metrics import instrumented
+
+logger = logging.getLogger(__name__)
+
+_api_client: Union[firefly_iii_client.ApiClient, None] = None
+_api_client_lock = threading.Lock()
+_executor: Union[ThreadPoolExecutor, None] = None
+
+
+def _options() -> dict:
+    return config.get('bot').get('firefly', dict())
+
+
+def _configuration() -> firefly_iii_client.Configuration:
+    ff = dict(config.get('firefly'))
+    access_token_file = ff.pop('access_token_file', None)
+    if access_token_file:
+        with open(access_token_file, 'r') as f:
+            ff['access_token'] = f.read()
+    return firefly_iii_client.Configuration(**ff)
+
+
+def get_api_client() -> firefly_iii_client.ApiClient:
+    """Returns the ApiClient shared by every handler.
+
+    Its urllib3 pool keeps connections to Firefly alive between requests, and idempotent requests
+    are retried with exponential backoff on connection errors and gateway errors.
+    """
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            options = _options()
+            ff_configuration = _configuration()
+            ff_configuration.connection_pool_maxsize = int(options.get('pool_size', 4))
+            # urllib3 only retries idempotent methods by default, so transactions are never posted twice
+            ff_configuration.retries = Retry(
+                total=int(options.get('retries', 3)),
+                backoff_factor=float(options.get('backoff', 0.5)),
+                status_forcelist=(502, 503, 504)
+            )
+            _api_client = firefly_iii_client.ApiClient(ff_configuration)
+            logger.info(f'Created Firefly API client for {ff_configuration.host}')
+        return _api_client
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Returns the executor for running Firefly requests concurrently, one thread per pooled connection."""
+    global _executor
+    with _api_client_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=int(_options().get('pool_size', 4)),
+                                           thread_name_prefix='firefly')
+        return _executor
+
+
+def run_in_executor(fn: Callable, *args) -> asyncio.Future:
+    """Starts a blocking Firefly request on the Firefly executor and returns a future the event loop can await.
+
+    The Firefly client only speaks blocking HTTP, so requests wait on its connection pool in these
+    threads and handlers waiting for them don't hold up any other update.
+    """
+    return asyncio.get_running_loop().run_in_executor(get_executor(), functools.partial(fn, *args))
+
+
+def close_api_client():
+    global _api_client, _executor
+    with _api_client_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+        if _api_client is not None:
+            _api_client.close()
+            _api_client = None
+
+
+def _request_timeout() -> float:
+    return float(_options().get('timeout', 10))
+
+
+@instrumented()
+def get_account(account_id: int, date: Union[datetime.date, None] = None) -> AccountRead:
+    kwargs = {'date': date} if date is not None else dict()
+    return accounts_api.AccountsApi(get_api_client()).get_account(
+        str(account_id), _request_timeout=_request_timeout(), **kwargs
+    ).data
+
+
+@instrumented()
+def list_asset_accounts() -> List[AccountRead]:
+    """Lists every asset account, following Firefly's pagination."""
+    api_instance = accounts_api.AccountsApi(get_api_client())
+
+    accounts = []
+    page, total_pages = 1, 1
+    while page <= total_pages:
+        response = api_instance.list_account(
+            type=AccountTypeFilter('asset'), page=page, _request_timeout=_request_timeout()
+        )
+        accounts.extend(response.data)
+
+        pagination = response.meta.get('pagination')
+        total_pages = pagination.get('total_pages', page) if pagination is not None else page
+        page += 1
+    return accounts
+
+
+class AccountCache:
+    """Asset accounts from Firefly, kept for ``ttl`` seconds between refreshes."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._accounts: Dict[str, AccountRead] = dict()
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self) -> bool:
+        return self._refreshed is None or time.monotonic() - self._refreshed > self.ttl
+
+    def refresh(self) -> List[AccountRead]:
+        accounts = list_asset_accounts()
+        with self._lock:
+            self._accounts = {account.id: account for account in accounts}
+            self._refreshed = time.monotonic()
+        logger.info(f'Refreshed {len(accounts)} cached asset accounts from Firefly')
+        return accounts
+
+    def list(self) -> List[AccountRead]:
+        if self.stale:
+            return self.refresh()
+        with self._lock:
+            return list(self._accounts.values())
+
+    def get(self, account_id: int, fresh: bool = False) -> AccountRead:
+        if not fresh and not self.stale:
+            with self._lock:
+                account = self._accounts.get(str(account_id))
+            if account is not None:
+                return account
+
+        account = get_account(account_id)
+        self.put(account)
+        return account
+
+    def put(self, account: AccountRead):
+        with self._lock:
+            self._accounts[account.id] = account
+
+    def set_balance(self, account_id: int, balance: float):
+        with self._lock:
+            account = self._accounts.get(str(account_id))
+            if account is not None:
+                account.attributes.current_balance = f'{balance:.2f}'
+
+
+_account_cache: Union[AccountCache, None] = None
+
+
+def get_account_cache() -> AccountCache:
+    global _account_cache
+    with _api_client_lock:
+        if _account_cache is None:
+            _account_cache = AccountCache(float(_options().get('cache_ttl', 300)))
+        return _account_cache
+
+
+async def refresh_account_cache(_: CallbackContext):
+    try:
+        await run_in_executor(get_account_cache().refresh)
+    except (firefly_iii_client.ApiException, HTTPError) as e:
+        logger.warning(f"Couldn't refresh cached asset accounts from FireflyIIAPI: {e}")
+
+
+@instrumented()
+def store_transaction(transaction_store: TransactionStore):
+    return transactions_api.TransactionsApi(get_api_client()).store_transaction(
+        transaction_store, _request_timeout=_request_timeout()
+    )
@@ -0,0 +1,290 @@
+"""Imports a directory or archive of balance screenshots for one user, without going through Telegram.
+
+Screenshots are matched and OCR'd on every core by the same pipeline balance updates use, in the
+order they were taken, and one JSON line is written per screenshot. Without ``--dry-run`` a
+back-dated balance adjustment is posted to Firefly for every balance read, against the account's
+balance on the day the screenshot was taken.
+
+    firefly-bot-import 12345678 ~/screenshots.zip --dry-run
+    firefly-bot-import 12345678 ~/screenshots --output import.jsonl
+
+Needs the bot's config.yml in the working directory. Screenshots already recorded in ``--output``
+are skipped, so an interrupted import picks up where it stopped when run again.
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import re
+import sys
+import tarfile
+import zipfile
+from dataclasses import dataclass
+from typing import Dict, IO, Iterator, List, Tuple, Union
+
+import cv2 as cv
+import firefly_iii_client
+from PIL import Image
+from urllib3.exceptions import HTTPError
+
+from firefly_bot.balance.commands import _balance_adjustment
+from firefly_bot.config import config, init_config
+from firefly_bot.firefly import close_api_client, get_account, store_transaction
+from firefly_bot.matching import TemplateSet
+from firefly_bot.screenshot import Screenshot
+from firefly_bot.utils import _THUMBNAIL_SIZE, _get_similar_accounts_from_screenshot, _get_user_accounts
+from firefly_bot.vision import _get_nearest_balances_from_screenshot, _get_screenshot_hash
+
+logger = logging.getLogger(__name__)
+
+_IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp')
+
+# e.g. Screenshot_20230131-101502.png, IMG_20230131_101502.jpg, Screenshot 2023-01-31 at 10.15.02.png,
+# Screenshot 2023-01-31 at 9.15.02 PM.png
+_FILENAME_TIMESTAMP = re.compile(
+    r'(?<!\d)(\d{4})[-_.]?(\d{2})[-_.]?(\d{2})'
+    r'(?:\D{1,4}(\d{1,2})[-_.:]?(\d{2})[-_.:]?(\d{2})(?:\s?([AaPp])\.?[Mm]\.?(?![A-Za-z]))?)?(?!\d)'
+)
+
+# EXIF tags holding when a photo was taken, most specific first
+_EXIF_IFD = 0x8769
+_EXIF_DATETIME_ORIGINAL = 0x9003
+_EXIF_DATETIME = 0x0132
+
+# Statuses of screenshots that don't need importing again, a dry run's are only done for another dry run
+_DONE = ('updated', 'unchanged', 'unknown', 'ambiguous', 'no_balance')
+_DONE_DRY_RUN = _DONE + ('dry_run',)
+
+_templates: Union[TemplateSet, None] = None
+_archives: Dict[str, Union[zipfile.ZipFile, tarfile.TarFile]] = dict()
+
+
+@dataclass
+class _Job:
+    name: str
+    # Archive the screenshot is in, None when it's a file of its own
+    archive: Union[str, None]
+    timestamp: datetime.datetime
+    timestamp_source: str
+
+
+def _open_archive(path: str) -> Union[zipfile.ZipFile, tarfile.TarFile]:
+    if path not in _archives:
+        _archives[path] = zipfile.ZipFile(path) if zipfile.is_zipfile(path) else tarfile.open(path)
+    return _archives[path]
+
+
+def _open(name: str, archive: Union[str, None]) -> IO[bytes]:
+    if archive is None:
+        return open(name, 'rb')
+
+    opened = _open_archive(archive)
+    return opened.open(name) if isinstance(opened, zipfile.ZipFile) else opened.extractfile(name)
+
+
+def _list_screenshots(source: pathlib.Path) -> Iterator[Tuple[str, Union[str, None], datetime.datetime]]:
+    """Yields the name, archive and modification time of every screenshot in a directory or archive."""
+    if source.is_dir():
+        for path in sorted(source.rglob('*')):
+            if path.suffix.lower() in _IMAGE_SUFFIXES:
+                yield str(path), None, datetime.datetime.fromtimestamp(path.stat().st_mtime)
+    elif zipfile.is_zipfile(source):
+        for info in _open_archive(str(source)).infolist():
+            if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in _IMAGE_SUFFIXES:
+                yield info.filename, str(source), datetime.datetime(*info.date_time)
+    elif tarfile.is_tarfile(source):
+        for info in _open_archive(str(source)).getmembers():
+            if info.isfile() and os.path.splitext(info.name)[1].lower() in _IMAGE_SUFFIXES:
+                yield info.name, str(source), datetime.datetime.fromtimestamp(info.mtime)
+    else:
+        raise ValueError(f'{source} is neither a directory nor a zip or tar archive')
+
+
+def _get_filename_timestamp(name: str) -> Union[datetime.datetime, None]:
+    for match in _FILENAME_TIMESTAMP.finditer(os.path.basename(name)):
+        *fields, meridiem = match.groups()
+        fields = [int(g) for g in fields if g is not None]
+        if meridiem is not None:
+            # 12 AM is midnight and 12 PM is noon, a 12-hour clock has no hour 0 or past 12
+            if not 1 <= fields[3] <= 12:
+                continue
+            fields[3] = fields[3] % 12 + (12 if meridiem in 'Pp' else 0)
+        try:
+            return datetime.datetime(*fields)
+        except ValueError:
+            continue
+    return None
+
+
+def _get_exif_timestamp(f: IO[bytes]) -> Union[datetime.datetime, None]:
+    try:
+        exif = Image.open(f).getexif()
+    except OSError:
+        return None
+
+    value = exif.get_ifd(_EXIF_IFD).get(_EXIF_DATETIME_ORIGINAL) or exif.get(_EXIF_DATETIME)
+    try:
+        return datetime.datetime.strptime(value, '%Y:%m:%d %H:%M:%S') if value else None
+    except ValueError:
+        return None
+
+
+def _get_job(name: str, archive: Union[str, None], modified: datetime.datetime) -> _Job:
+    """Works out when a screenshot was taken, from its EXIF data, its name or else its modification time."""
+    # Only the image header is read for EXIF data, the pixels are never decoded
+    with _open(name, archive) as f:
+        timestamp = _get_exif_timestamp(f)
+    if timestamp is not None:
+        return _Job(name, archive, timestamp, 'exif')
+
+    timestamp = _get_filename_timestamp(name)
+    if timestamp is not None:
+        return _Job(name, archive, timestamp, 'filename')
+    return _Job(name, archive, modified, 'mtime')
+
+
+def _get_thumbnail(screenshot: Screenshot) -> Screenshot:
+    """Scales a screenshot down like the rendition Telegram makes of it, which templates are hashed from."""
+    size = config.get('bot').get('screenshots').get('thumbnail', _THUMBNAIL_SIZE)
+    scale = size / min(screenshot.size)
+    if scale >= 1:
+        return screenshot
+
+    pixels = cv.resize(screenshot.pixels, None, fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+    _, data = cv.imencode('.jpg', cv.cvtColor(pixels, cv.COLOR_RGB2BGR))
+    return Screenshot(data.tobytes())
+
+
+def _init_worker(accounts: List[dict]):
+    global _templates
+    # Spawned workers don't inherit the config loaded by the parent
+    init_config()
+    _templates = TemplateSet(accounts)
+    # Archives opened before forking share their file offset with the parent, so every worker opens its own
+    _archives.clear()
+
+
+def _read_screenshot(job: _Job) -> dict:
+    """Matches and OCRs one screenshot in a worker process, returning its JSON record."""
+    record = {'file': job.name, 'archive': job.archive, 'timestamp': job.timestamp.isoformat(),
+              'timestamp_source': job.timestamp_source}
+    try:
+        with _open(job.name, job.archive) as f:
+            screenshot = Screenshot(f.read())
+
+        thumbnail = _get_thumbnail(screenshot)
+        matches = _get_similar_accounts_from_screenshot(lambda a: _get_screenshot_hash(thumbnail, a), _templates)
+        accounts = [m.account for m in matches]
+        record['accounts'] = [{'id': int(a.get('id')), 'name': a.get('name')} for a in accounts]
+
+        if not accounts:
+            record['status'] = 'unknown'
+        elif any(a.get('relationship') != accounts[0].get('relationship') for a in accounts):
+            record['status'] = 'ambiguous'
+        else:
+            balances = _get_nearest_balances_from_screenshot(screenshot, [a.get('image') for a in accounts])
+            for account, balance in zip(record['accounts'], balances):
+                if balance is not None:
+                    account['balance'] = float(balance.price.amount)
+                    account['currency'] = balance.price.currency
+            record['status'] = 'read' if any(b is not None for b in balances) else 'no_balance'
+    except Exception as e:
+        logger.exception(f'Failed reading screenshot {job.name}')
+        record['status'], record['error'] = 'error', str(e)
+    return record
+
+
+def _post_balance(account_id: int, balance: float, timestamp: datetime.datetime) -> float:
+    """Posts the adjustment that brings an account to ``balance`` as of ``timestamp``, returns the difference."""
+    account_record = get_account(account_id, date=timestamp.date())
+    balance_difference = round(balance - float(account_record.attributes.current_balance), 2)
+    if abs(balance_difference) > 0:
+        try:
+            store_transaction(_balance_adjustment(account_id, balance_difference, timestamp))
+        except TypeError as e:
+            # Issue with transaction API ?
+            logger.error(e)
+    return balance_difference
+
+
+def _post_record(record: dict) -> dict:
+    timestamp = datetime.datetime.fromisoformat(record['timestamp'])
+    updated = False
+    try:
+        for account in record['accounts']:
+            if 'balance' in account:
+                account['difference'] = _post_balance(account['id'], account['balance'], timestamp)
+                updated = updated or account['difference'] != 0
+    except (firefly_iii_client.ApiException, HTTPError) as e:
+        logger.error(f"Failed posting balances read from {record['file']}: {e}")
+        record['status'], record['error'] = 'error', str(e)
+        return record
+    except Exception as e:
+        # One screenshot failing doesn't stop an import of thousands
+        logger.exception(f"Failed posting balances read from {record['file']}")
+        record['status'], record['error'] = 'error', str(e)
+        return record
+
+    record['status'] = 'updated' if updated else 'unchanged'
+    return record
+
+
+def _get_done(output: Union[pathlib.Path, None], dry_run: bool) -> set:
+    """The screenshots a previous run already recorded as done in the same output file."""
+    if output is None or not output.exists():
+        return set()
+
+    statuses = _DONE_DRY_RUN if dry_run else _DONE
+
+    done = set()
+    with output.open('r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('status') in statuses:
+                done.add((record.get('archive'), record.get('file')))
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('user_id', type=int, help='Telegram user ID whose account templates are matched')
+    parser.add_argument('source', type=pathlib.Path, help='Directory, zip or tar archive of screenshots')
+    parser.add_argument('--dry-run', action='store_true', help="Only read balances, don't post to Firefly")
+    parser.add_argument('--output', type=pathlib.Path, help='Append JSON lines to this file instead of stdout')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: every core)')
+    args = parser.parse_args()
+
+    init_config()
+    accounts = list(_get_user_accounts(args.user_id).values())
+    if not accounts:
+        parser.error(f'User {args.user_id} has no accounts set up')
+
+    done = _get_done(args.output, args.dry_run)
+    jobs = [_get_job(name, archive, modified) for name, archive, modified in _list_screenshots(args.source)
+            if (archive, name) not in done]
+    # Adjustments are posted in the order screenshots were taken, each against the balance on its day
+    jobs.sort(key=lambda j: j.timestamp)
+    logger.info(f'Importing {len(jobs)} screenshots for user {args.user_id}, skipping {len(done)} already done')
+
+    out = args.output.open('a') if args.output else sys.stdout
+    try:
+        with multiprocessing.Pool(args.processes, _init_worker, (accounts,)) as pool:
+            for record in pool.imap(_read_screenshot, jobs, chunksize=4):
+                if record['status'] == 'read':
+                    record = dict(record, status='dry_run') if args.dry_run else _post_record(record)
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        close_api_client()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import dataclasses
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import TYPE_CHECKING, Dict, List, Union
+
+from firefly_bot.config import config
+from firefly_bot.data import LibraryTemplate
+
+if TYPE_CHECKING:
+    from imagehash import ImageHash
+
+    from firefly_bot.matching import BKTree
+
+logger = logging.getLogger(__name__)
+
+_library: Union['TemplateLibrary', None] = None
+_library_lock = threading.Lock()
+
+
+class TemplateLibrary:
+    """Templates of known app layouts shared by every user, stored in one JSON file.
+
+    Templates are indexed in a :class:`BKTree` per hash algorithm, so looking a screenshot up
+    stays sub-linear as the library grows. Templates hold no account details, only a hash and
+    where the balance is on the screen.
+    """
+
+    def __init__(self, path: str, threshold: int):
+        self.path = path
+        self.threshold = threshold
+        self._trees: Dict[str, 'BKTree'] = dict()
+        self._templates: List[LibraryTemplate] = []
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for template in json.load(f):
+                    self._index(LibraryTemplate(**template))
+        logger.info(f'Loaded {len(self._templates)} templates from {path}')
+
+    def __len__(self):
+        return len(self._templates)
+
+    def _index(self, template: LibraryTemplate):
+        from firefly_bot.matching import BKTree
+        self._templates.append(template)
+        self._trees.setdefault(template.algorithm, BKTree()).add(template.hash, template)
+
+    def lookup(self, algorithm: str, image_hash: 'ImageHash') -> Union[LibraryTemplate, None]:
+        tree = self._trees.get(algorithm)
+        if tree is None:
+            return None
+
+        # The threshold is exclusive, as it is for matching a user's own templates
+        found = tree.search(image_hash.hash, self.threshold - 1)
+        return found[0][1] if found else None
+
+    def add(self, template: LibraryTemplate) -> bool:
+        """Adds a template unless the library already knows the layout, returns whether it was added."""
+        with self._lock:
+            tree = self._trees.get(template.algorithm)
+            if tree is not None and tree.search(template.hash, self.threshold - 1):
+                return False
+
+            self._index(template)
+            data = json.dumps([dataclasses.asdict(t) for t in self._templates])
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.json')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.path)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+            return True
+
+
+def get_template_library() -> Union[TemplateLibrary, None]:
+    """The shared template library, or None when ``bot.templates`` isn't enabled."""
+    global _library
+    templates = config.get('bot').get('templates', dict())
+    if not templates.get('enabled'):
+        return None
+
+    with _library_lock:
+        if _library is None:
+            path = templates.get('path') or os.path.join(config.get('bot').get('storage').get('path'),
+                                                         'templates.json')
+            _library = TemplateLibrary(path, int(templates.get('threshold', 10)))
+        return _library
+
+
+def get_library_hash() -> str:
+    return config.get('bot').get('templates', dict()).get('hash', 'phash')
@@ -0,0 +1,160 @@
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+import numpy as np
+from imagehash import ImageHash
+
+from firefly_bot.data import AccountMatch, Balance
+
+# Number of set bits for every possible byte value, used to popcount packed hashes.
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class TemplateMatrix:
+    """Stored account image hashes packed into a single bit matrix.
+
+    Each row holds the packed bits of one account's hash, so the Hamming distance between a
+    screenshot and every account can be computed with one vectorized XOR and popcount.
+    Accounts whose stored hash has a different length (e.g. hashed with another algorithm)
+    are kept in separate matrices and never compared against the screenshot.
+
+    With an ``algorithm`` the hash stored for it under ``image.hashes`` is used, falling back to the
+    legacy ``image.hash`` when ``legacy`` is set. Accounts with no usable hash are left out.
+    """
+
+    def __init__(self, accounts: Iterable[Dict], algorithm: Union[str, None] = None, legacy: bool = True):
+        rows = dict()
+        self.ids: Set[int] = set()
+        for account in accounts:
+            image = account.get('image')
+            hash_bits = image.get('hashes', dict()).get(algorithm) if algorithm else None
+            if hash_bits is None and legacy:
+                hash_bits = image.get('hash')
+            if hash_bits is None:
+                continue
+
+            bits = np.asarray(hash_bits, dtype=bool).flatten()
+            rows.setdefault(bits.size, ([], []))
+            rows[bits.size][0].append(account)
+            rows[bits.size][1].append(np.packbits(bits))
+            self.ids.add(int(account.get('id')))
+
+        self._matrices = {size: (accs, np.stack(packed)) for size, (accs, packed) in rows.items()}
+
+    def __len__(self):
+        return sum(len(accs) for accs, _ in self._matrices.values())
+
+    def rank(self, image_hash: ImageHash) -> List[AccountMatch]:
+        bits = np.asarray(image_hash.hash, dtype=bool).flatten()
+        if bits.size not in self._matrices:
+            return []
+
+        accounts, matrix = self._matrices[bits.size]
+        distances = _POPCOUNT[np.bitwise_xor(matrix, np.packbits(bits))].sum(axis=1, dtype=np.int64)
+        return [AccountMatch(accounts[i], int(distances[i])) for i in np.argsort(distances, kind='stable')]
+
+
+class TemplateSet:
+    """A user's accounts with a :class:`TemplateMatrix` built lazily for every hash algorithm asked for."""
+
+    def __init__(self, accounts: Iterable[Dict]):
+        self.accounts = list(accounts)
+        self._matrices: Dict[Tuple[str, bool], TemplateMatrix] = dict()
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def matrix(self, algorithm: str, legacy: bool = False) -> TemplateMatrix:
+        key = (algorithm, legacy)
+        if key not in self._matrices:
+            self._matrices[key] = TemplateMatrix(self.accounts, algorithm, legacy)
+        return self._matrices[key]
+
+
+def _hash_key(hash_bits) -> Tuple[int, int]:
+    """Packs hash bits into an integer, paired with the number of bits so hashes of different lengths never meet."""
+    bits = np.asarray(hash_bits, dtype=bool).flatten()
+    return bits.size, int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class BKTree:
+    """Burkhard-Keller tree over hashes under the Hamming distance.
+
+    Every child sits under the edge labelled with its distance to the parent, so by the triangle
+    inequality a search within ``radius`` only has to descend edges within ``radius`` of the
+    distance to each visited node, leaving most of the tree unvisited for small radii.
+    """
+
+    def __init__(self):
+        self._root: Union[list, None] = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def _distance(a: int, b: int) -> int:
+        return bin(a ^ b).count('1')
+
+    def add(self, hash_bits, value: Any):
+        key = _hash_key(hash_bits)
+        self._size += 1
+        if self._root is None:
+            self._root = [key, value, dict()]
+            return
+
+        node = self._root
+        while True:
+            if node[0][0] != key[0]:
+                raise ValueError(f'Hash of {key[0]} bits added to a tree of {node[0][0]} bit hashes')
+            distance = self._distance(node[0][1], key[1])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, dict()]
+                return
+            node = child
+
+    def search(self, hash_bits, radius: int) -> List[Tuple[int, Any]]:
+        """Returns ``(distance, value)`` of every hash within ``radius``, nearest first."""
+        size, key = _hash_key(hash_bits)
+        if self._root is None or self._root[0][0] != size:
+            return []
+
+        found = []
+        stack = [self._root]
+        while stack:
+            (_, node_key), value, children = stack.pop()
+            distance = self._distance(node_key, key)
+            if distance <= radius:
+                found.append((distance, value))
+            stack.extend(child for d, child in children.items() if distance - radius <= d <= distance + radius)
+
+        found.sort(key=lambda f: f[0])
+        return found
+
+
+class BalanceIndex:
+    """Balances parsed from one OCR pass, indexed by location for nearest-balance lookups."""
+
+    def __init__(self, balances: List[Balance]):
+        self.balances = balances
+        self._points = np.array([(b.x, b.y) for b in balances], dtype=np.float64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.balances)
+
+    def nearest(self, x: float, y: float,
+                bounds: Union[Tuple[float, float, float, float], None] = None) -> Union[Balance, None]:
+        """Returns the balance nearest to ``x``/``y``, optionally only considering those within
+        the ``(left, top, right, bottom)`` bounds."""
+        candidates = np.arange(len(self.balances))
+        if bounds is not None:
+            left, top, right, bottom = bounds
+            inside = (self._points[:, 0] >= left) & (self._points[:, 0] < right) & \
+                     (self._points[:, 1] >= top) & (self._points[:, 1] < bottom)
+            candidates = candidates[inside]
+
+        if not candidates.size:
+            return None
+
+        dists = np.hypot(self._points[candidates, 0] - x, self._points[candidates, 1] - y)
+        return self.balances[candidates[np.argmin(dists)]]
@@ -0,0 +1,81 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+from typing import Callable, Union
+
+from prometheus_client import Gauge, Histogram, start_http_server
+
+from firefly_bot.config import config
+
+logger = logging.getLogger(__name__)
+
+STAGE_SECONDS = Histogram(
+    'firefly_bot_stage_seconds', 'Time spent in each stage of handling an update',
+    ['stage', 'outcome', 'hash'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+)
+STAGE_IN_FLIGHT = Gauge('firefly_bot_stage_in_flight', 'Number of calls currently in each stage', ['stage'])
+QUEUE_DEPTH = Gauge('firefly_bot_queue_depth', 'Number of jobs waiting or running in each queue', ['queue'])
+
+
+def _hash_algorithm() -> str:
+    return config.get('bot').get('screenshots').get('hash')
+
+
+def observe(stage: str, seconds: float, outcome: str = 'ok', hashed: Union[bool, str] = False):
+    """``hashed`` labels the stage with the configured image hash algorithm, or with the algorithm given."""
+    if hashed is True:
+        hashed = _hash_algorithm()
+    STAGE_SECONDS.labels(stage, outcome, hashed or '').observe(seconds)
+
+
+def instrumented(stage: Union[str, None] = None, hashed: bool = False):
+    """Records the duration, outcome and in-flight count of every call to the decorated function.
+
+    ``stage`` defaults to the function's module and name, e.g. ``balance.commands.timeout``.
+    ``hashed`` labels the stage with the configured image hash algorithm.
+    """
+    def decorator(func: Callable):
+        name = stage or f"{func.__module__.replace('firefly_bot.', '')}.{func.__name__}"
+
+        # Coroutines are timed until they finish, not until they return their coroutine object
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _observed(name, hashed):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _observed(name, hashed):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def _observed(stage: str, hashed: bool):
+    outcome = 'error'
+    start = time.perf_counter()
+    with STAGE_IN_FLIGHT.labels(stage).track_inprogress():
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            observe(stage, time.perf_counter() - start, outcome, hashed)
+
+
+def track_queue(queue: str, depth: Callable[[], float]):
+    QUEUE_DEPTH.labels(queue).set_function(depth)
+
+
+def start_metrics_server():
+    metrics = config.get('bot').get('metrics', dict())
+    if not metrics.get('enabled'):
+        return
+
+    start_http_server(int(metrics.get('port', 9090)), metrics.get('listen', '0.0.0.0'))
+    logger.info(f"Serving metrics on {metrics.get('listen', '0.0.0.0')}:{metrics.get('port', 9090)}")
@@ -0,0 +1,77 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List
+
+import numpy as np
+from pytesseract import pytesseract
+
+# Sparse text, balances can sit anywhere on the screenshot
+_TESSERACT_PSM = 11
+
+
+class OcrBackend(ABC):
+    """Turns a preprocessed grayscale image into Tesseract's word level data.
+
+    The result has the same shape as ``pytesseract.image_to_data`` with ``Output.DICT``, parallel
+    lists under ``text``, ``left``, ``top``, ``width``, ``height`` and ``conf``.
+    """
+
+    @abstractmethod
+    def image_to_data(self, img: np.ndarray) -> Dict[str, List]:
+        raise NotImplementedError
+
+
+class PytesseractBackend(OcrBackend):
+    """Runs the ``tesseract`` binary for every image, reloading the language model each time."""
+
+    def image_to_data(self, img: np.ndarray) -> Dict[str, List]:
+        return pytesseract.image_to_data(img, config=f'--psm {_TESSERACT_PSM}', output_type=pytesseract.Output.DICT)
+
+
+class TesserocrBackend(OcrBackend):
+    """Keeps a Tesseract API handle loaded for the life of the process and hands it pixel buffers directly.
+
+    Requires the optional ``tesserocr`` package.
+    """
+
+    def __init__(self):
+        import tesserocr
+
+        self._tesserocr = tesserocr
+        self._api = tesserocr.PyTessBaseAPI(psm=_TESSERACT_PSM)
+
+    def image_to_data(self, img: np.ndarray) -> Dict[str, List]:
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        height, width = img.shape
+        self._api.SetImageBytes(img.tobytes(), width, height, 1, width)
+        self._api.Recognize()
+
+        data = {'text': [], 'left': [], 'top': [], 'width': [], 'height': [], 'conf': []}
+        level = self._tesserocr.RIL.WORD
+        for word in self._tesserocr.iterate_level(self._api.GetIterator(), level):
+            bounding_box = word.BoundingBox(level)
+            if bounding_box is None:
+                continue
+
+            x1, y1, x2, y2 = bounding_box
+            data['text'].append(word.GetUTF8Text(level))
+            data['left'].append(x1)
+            data['top'].append(y1)
+            data['width'].append(x2 - x1)
+            data['height'].append(y2 - y1)
+            data['conf'].append(word.Confidence(level))
+        return data
+
+
+OCR_BACKENDS = {
+    'pytesseract': PytesseractBackend,
+    'tesserocr': TesserocrBackend
+}
+
+_backends: Dict[str, OcrBackend] = dict()
+
+
+def get_ocr_backend(name: str) -> OcrBackend:
+    """Returns this process's instance of the named backend, creating it on first use."""
+    if name not in _backends:
+        _backends[name] = OCR_BACKENDS[name]()
+    return _backends[name]
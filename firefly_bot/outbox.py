@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Awaitable, Callable, Deque, Dict, Union
+
+from telegram import Chat, Message
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import Application
+
+from firefly_bot.config import config
+from firefly_bot.metrics import observe, track_queue
+
+logger = logging.getLogger(__name__)
+
+# Seconds messages still queued when the bot stops are given to be sent
+_CLOSE_TIMEOUT = 10
+
+
+class _Throttle:
+    """Spaces calls to :meth:`wait` at least ``interval`` seconds apart."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        # The slot is taken before sleeping, so concurrent callers queue up behind each other
+        at = max(now, self._next)
+        self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def pause(self, seconds: float):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+@dataclass
+class _Message:
+    send: Callable[[], Awaitable]
+    # Consecutive messages with the same status replace each other while they wait to be sent
+    status: Union[str, None] = None
+    # Whether the chat's own send rate applies, deleting a message only counts towards the global rate
+    limited: bool = True
+
+
+@dataclass
+class _Chat:
+    throttle: _Throttle
+    messages: Deque[_Message] = field(default_factory=deque)
+    sending: Union[_Message, None] = None
+    task: Union[asyncio.Task, None] = None
+
+
+class Outbox:
+    """Sends the bot's messages in the background, within Telegram's flood limits.
+
+    Messages are queued per chat and sent in order, at most ``rate`` a second overall and
+    ``chat_rate`` a second to any one chat (``group_rate`` a minute to groups). A message that
+    Telegram turns away with a 429 is retried after the ``retry_after`` it asks for, up to
+    ``retries`` times. Handlers post their replies and carry on without waiting for them.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, group_rate: float, retries: int):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.retries = retries
+        self._throttle = _Throttle(1 / rate)
+        self._chats: Dict[int, _Chat] = dict()
+
+    @property
+    def pending(self) -> int:
+        return sum(len(chat.messages) + (chat.sending is not None) for chat in self._chats.values())
+
+    def post(self, chat: Chat, send: Callable[[], Awaitable], status: Union[str, None] = None,
+             limited: bool = True):
+        queue = self._chats.get(chat.id)
+        if queue is None:
+            interval = 1 / self.chat_rate if chat.type == Chat.PRIVATE else 60 / self.group_rate
+            queue = self._chats[chat.id] = _Chat(_Throttle(interval))
+
+        if status is not None and queue.messages and queue.messages[-1].status == status:
+            queue.messages[-1] = _Message(send, status, limited)
+            logger.debug(f'Coalesced {status} message to chat {chat.id}')
+        else:
+            queue.messages.append(_Message(send, status, limited))
+
+        if queue.task is None:
+            queue.task = asyncio.get_running_loop().create_task(self._drain(chat.id, queue))
+
+    async def _drain(self, chat_id: int, queue: _Chat):
+        try:
+            while queue.messages:
+                queue.sending = queue.messages.popleft()
+                try:
+                    await self._send(chat_id, queue, queue.sending)
+                except Exception:
+                    logger.exception(f'Failed sending to chat {chat_id}')
+                queue.sending = None
+        finally:
+            queue.sending = queue.task = None
+
+    async def _send(self, chat_id: int, queue: _Chat, message: _Message):
+        for _ in range(self.retries + 1):
+            if message.limited:
+                await queue.throttle.wait()
+            await self._throttle.wait()
+
+            start = time.perf_counter()
+            try:
+                await message.send()
+            except RetryAfter as e:
+                observe('telegram.send', time.perf_counter() - start, 'retry')
+                logger.warning(f'Flood limit reached sending to chat {chat_id}, retrying in {e.retry_after}s')
+                # The limit may be the bot's overall one, so nothing else is sent until it has passed either
+                queue.throttle.pause(e.retry_after)
+                self._throttle.pause(e.retry_after)
+                continue
+            except TelegramError as e:
+                observe('telegram.send', time.perf_counter() - start, 'error')
+                logger.error(f"Couldn't send to chat {chat_id}: {e}")
+                return
+
+            observe('telegram.send', time.perf_counter() - start)
+            if message.limited:
+                # Telegram times messages by when they arrive, so the interval is counted from the reply
+                queue.throttle.pause(queue.throttle.interval)
+            return
+
+        logger.error(f'Gave up sending to chat {chat_id} after {self.retries} retries')
+
+    async def close(self, timeout: float):
+        """Waits up to ``timeout`` seconds for every queued message to be sent."""
+        tasks = [chat.task for chat in self._chats.values() if chat.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+
+_outbox: Union[Outbox, None] = None
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    if _outbox is None:
+        outbox = config.get('bot').get('outbox', dict())
+        _outbox = Outbox(float(outbox.get('rate', 30)), float(outbox.get('chat_rate', 1)),
+                         float(outbox.get('group_rate', 20)), int(outbox.get('retries', 3)))
+        track_queue('outbox', lambda: _outbox.pending)
+    return _outbox
+
+
+def reply_text(message: Message, text: str, status: Union[str, None] = None, **kwargs):
+    get_outbox().post(message.chat, partial(message.reply_text, text, **kwargs), status)
+
+
+def reply_markdown(message: Message, text: str, status: Union[str, None] = None, **kwargs):
+    get_outbox().post(message.chat, partial(message.reply_markdown, text, **kwargs), status)
+
+
+def delete(message: Message):
+    get_outbox().post(message.chat, message.delete, limited=False)
+
+
+async def close_outbox(_: Application):
+    if _outbox is not None:
+        await _outbox.close(_CLOSE_TIMEOUT)
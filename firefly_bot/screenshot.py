@@ -0,0 +1,68 @@
+from io import BytesIO
+from typing import TYPE_CHECKING, Tuple, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
+
+class Screenshot:
+    """An encoded screenshot, decoded at most once into the pixels that hashing and OCR both work on.
+
+    Only the encoded bytes are pickled, so handing a screenshot to a worker process costs no more
+    than handing it the bytes, and the worker decodes it once for every stage it runs on it. The
+    imaging libraries are only imported once pixels are asked for, which the bot process never does.
+    """
+
+    def __init__(self, data: Union[bytes, bytearray]):
+        self.data = data
+        self._size: Union[Tuple[int, int], None] = None
+        self._pixels: Union['np.ndarray', None] = None
+        self._gray: Union['np.ndarray', None] = None
+
+    def __getstate__(self):
+        return {'data': self.data}
+
+    def __setstate__(self, state):
+        self.__init__(state['data'])
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """Width and height, read from the image header alone when the pixels aren't decoded yet."""
+        if self._size is None:
+            if self._pixels is not None:
+                self._size = self._pixels.shape[1], self._pixels.shape[0]
+            else:
+                from PIL import Image
+                self._size = Image.open(BytesIO(self.data)).size
+        return self._size
+
+    @property
+    def pixels(self) -> 'np.ndarray':
+        """RGB pixels, decoded straight from the encoded bytes without copying them first."""
+        if self._pixels is None:
+            import cv2 as cv
+            import numpy as np
+
+            bgr = cv.imdecode(np.frombuffer(self.data, dtype=np.uint8), cv.IMREAD_COLOR)
+            self._pixels = cv.cvtColor(bgr, cv.COLOR_BGR2RGB, dst=bgr)
+            self._pixels.setflags(write=False)
+        return self._pixels
+
+    @property
+    def gray(self) -> 'np.ndarray':
+        if self._gray is None:
+            import cv2 as cv
+
+            self._gray = cv.cvtColor(self.pixels, cv.COLOR_RGB2GRAY)
+            self._gray.setflags(write=False)
+        return self._gray
+
+    @property
+    def image(self) -> 'Image.Image':
+        """A PIL view of the pixels for image hashing."""
+        from PIL import Image
+        return Image.fromarray(self.pixels)
@@ -1,4 +1,4 @@
-from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler, Filters, MessageHandler
+from telegram.ext import CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler, filters
 
 from firefly_bot.setup import commands
 
@@ -6,11 +6,13 @@ conv_handler = ConversationHandler(
     entry_points=[CommandHandler('setup', commands.account)],
     states={
         commands.ACCOUNT: [CallbackQueryHandler(commands.account_chosen)],
-        commands.EXAMPLE: [MessageHandler(Filters.photo, commands.example)],
+        commands.EXAMPLE: [MessageHandler(filters.PHOTO, commands.example, block=False)],
         commands.BALANCE: [CallbackQueryHandler(commands.balance_chosen)],
         commands.RELATED: [CallbackQueryHandler(commands.relation_chosen)],
         commands.CONFIRM: [CallbackQueryHandler(commands.confirm)],
-        ConversationHandler.TIMEOUT: [MessageHandler(Filters.text, commands.timeout)]
+        # A screenshot sent while the last one is still being processed
+        ConversationHandler.WAITING: [MessageHandler(filters.PHOTO, commands.example_busy)],
+        ConversationHandler.TIMEOUT: [MessageHandler(filters.TEXT, commands.timeout)]
     },
     fallbacks=[CommandHandler('cancel', commands.cancel)],
     conversation_timeout=120
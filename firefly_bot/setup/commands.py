@@ -1,33 +1,33 @@
 import logging
-import os
 from collections import defaultdict
-from io import BytesIO
 
 import firefly_iii_client
 import i18n
-import imagehash
-from PIL import Image
-from firefly_iii_client.api import accounts_api
-from firefly_iii_client.model.account_type_filter import AccountTypeFilter
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import CallbackContext, ConversationHandler
 
-from firefly_bot.config import config, ff_configuration
+from firefly_bot.config import config
+from firefly_bot.data import LibraryTemplate
+from firefly_bot.firefly import get_account_cache, run_in_executor
+from firefly_bot.library import get_library_hash, get_template_library
+from firefly_bot.metrics import instrumented
+from firefly_bot.outbox import delete, reply_markdown, reply_text
 from firefly_bot.setup.data import Setup
-from firefly_bot.utils import _get_balances_from_screenshot, _get_similar_accounts_from_screenshot, _get_user_file, \
-    _write_user_file
+from firefly_bot.utils import _OCR_SCALE, _add_user_account, _download_screenshot, _get_hash_cascade, \
+    _get_similar_accounts_from_screenshot, _get_thumbnail, _get_user_accounts, _get_user_templates, _user_exists
+from firefly_bot.workers import WorkerPoolFull, run_in_worker
 
 ACCOUNT, EXAMPLE, BALANCE, RELATED, CONFIRM = range(5)
 
 logger = logging.getLogger(__name__)
 
 
-def account(update: Update, context: CallbackContext) -> int:
-    user_file = os.path.join(config.get('bot').get('storage').get('path'), f'{update.message.from_user.id}.json')
-    if not os.path.exists(user_file):
+@instrumented()
+async def account(update: Update, context: CallbackContext) -> int:
+    if not _user_exists(update.message.from_user.id):
         logger.info(f"{update.effective_user.name}:{update.effective_user.id} tried starting "
                     f"setup before account registration")
-        update.message.reply_text(i18n.t('setup.user_file_missing'))
+        reply_text(update.message, i18n.t('setup.user_file_missing'))
         return ConversationHandler.END
 
     logger.info(f"{update.effective_user.name}:{update.effective_user.id} is starting setup")
@@ -35,83 +35,109 @@ def account(update: Update, context: CallbackContext) -> int:
     setup = Setup()
     context.user_data['setup'] = setup
 
-    user = _get_user_file(update.message.from_user.id)
-    accounts = user.get('accounts', dict())
+    accounts = _get_user_accounts(update.message.from_user.id)
 
-    with firefly_iii_client.ApiClient(ff_configuration) as api_client:
-        api_instance = accounts_api.AccountsApi(api_client)
-
-        try:
-            api_response = api_instance.list_account(type=AccountTypeFilter('asset'))
-            setup.accounts = api_response.data
+    try:
+        setup.accounts = await run_in_executor(get_account_cache().list)
+    except firefly_iii_client.ApiException as e:
+        logger.warning(f"Couldn't connect to FireflyIIAPI: {e}")
+        reply_text(update.message, i18n.t('general.firefly_no_connect', reason=e.reason))
+        return ConversationHandler.END
 
-            keyboard = []
-            for i, account_record in enumerate(api_response.data):
-                if account_record.id not in accounts:
-                    acc = account_record.attributes
-                    keyboard.append([InlineKeyboardButton(
-                        text=acc.name,
-                        callback_data=i
-                    )])
+    keyboard = []
+    for i, account_record in enumerate(setup.accounts):
+        if account_record.id not in accounts:
+            acc = account_record.attributes
+            keyboard.append([InlineKeyboardButton(
+                text=acc.name,
+                callback_data=i
+            )])
 
-            logger.info(f"Found {len(setup.accounts)} asset accounts from FireflyIIAPI")
+    logger.info(f"Found {len(setup.accounts)} asset accounts from FireflyIIAPI")
 
-            update.message.reply_text(i18n.t('setup.which_account'), reply_markup=InlineKeyboardMarkup(keyboard))
+    reply_text(update.message, i18n.t('setup.which_account'), reply_markup=InlineKeyboardMarkup(keyboard))
 
-            return ACCOUNT
-        except firefly_iii_client.ApiException as e:
-            logger.warning(f"Couldn't connect to FireflyIIAPI: {e}")
-            update.message.reply_text(i18n.t('general.firefly_no_connect', reason=e.reason))
-            return ConversationHandler.END
+    return ACCOUNT
 
 
-def account_chosen(update: Update, context: CallbackContext) -> int:
+@instrumented()
+async def account_chosen(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     setup = context.user_data.get('setup')
     setup.chosen_account = setup.accounts[int(query.data)]
 
-    query.message.reply_markdown(i18n.t('setup.account_setup_begin', name=setup.chosen_account.attributes.name))
+    reply_markdown(query.message, i18n.t('setup.account_setup_begin', name=setup.chosen_account.attributes.name))
 
     logger.info(f"{query.from_user.name}:{query.from_user.id} is "
                 f"configuring an account {setup.chosen_account.attributes.name}:{setup.chosen_account.id}")
     return EXAMPLE
 
 
-def example(update: Update, context: CallbackContext) -> int:
+@instrumented()
+async def example(update: Update, context: CallbackContext) -> int:
     setup = context.user_data.get('setup')
-    user = _get_user_file(update.message.from_user.id)
-    update.message.delete()
+    delete(update.message)
 
-    with BytesIO() as b:
-        screenshot_file = update.message.photo[-1].get_file()
-        screenshot_file.download(out=b)
-        b.seek(0)
+    setup.screenshot = await _download_screenshot(update.message.photo[-1])
 
-        img = Image.open(b)
-        image_hash_func = getattr(imagehash, config.get('bot').get('screenshots').get('hash'))
-        setup.screenshot = b
-        setup.screenshot_hash = image_hash_func(img)
-
-        b.seek(0)
-        balances = list(_get_balances_from_screenshot(b))
+    # Balance updates match the same small rendition against this hash
+    thumbnail_size = _get_thumbnail(update.message.photo)
+    library = get_template_library()
+    if thumbnail_size.file_unique_id == update.message.photo[-1].file_unique_id:
+        thumbnail = setup.screenshot
+    else:
+        thumbnail = await _download_screenshot(thumbnail_size)
+
+    try:
+        # Every hash the cascade matches with is stored, so templates never have to be rehashed
+        algorithms = [algorithm for algorithm, _ in _get_hash_cascade()]
+        if library is not None and get_library_hash() not in algorithms:
+            algorithms.append(get_library_hash())
+        # One job, so a thumbnail that is the full size photo is decoded only once
+        setup.screenshot_hashes, balances = await run_in_worker(
+            update, '_get_hashes_and_balances_from_screenshot', setup.screenshot, thumbnail, algorithms
+        )
+    except WorkerPoolFull:
+        logger.warning('Worker pool is full, rejected setup screenshot')
+        reply_text(update.message, i18n.t('general.busy'))
+        return EXAMPLE
 
-        b.seek(0)
-        accounts = list(user.get('accounts', dict()).values())
-        setup.sim_accounts = _get_similar_accounts_from_screenshot(b, accounts)
+    matches = _get_similar_accounts_from_screenshot(
+        setup.screenshot_hashes.get,
+        _get_user_templates(update.message.from_user.id)
+    )
+    setup.sim_accounts = [m.account for m in matches]
 
-        logger.info(f"{update.effective_user.name}:{update.effective_user.id} submitted screenshot for setup: {img}, "
-                    f"found {len(balances)} balances, "
-                    f"found {len(setup.sim_accounts)} accounts with similar image hashes")
+    logger.info(f"{update.effective_user.name}:{update.effective_user.id} submitted screenshot for setup: "
+                f"{', '.join(str(h) for h in setup.screenshot_hashes.values())}, "
+                f"found {len(balances)} balances, "
+                f"found {len(setup.sim_accounts)} accounts with similar image hashes")
     if not balances:
-        update.message.reply_text(i18n.t('setup.example_no_balance'))
+        reply_text(update.message, i18n.t('setup.example_no_balance'))
         logger.warning(f"Found NO balances, maintaining state...")
         return EXAMPLE
     elif len(balances) == 1:
         setup.chosen_balance = balances.pop()
         logger.info(f"Found only a single balance, passing...")
-        return _check_relationships(update, context)
+        return await _check_relationships(update, context)
     else:
+        message = i18n.t('setup.example_balance_found', name=setup.chosen_account.attributes.name)
+
+        # A layout already in the shared library tells which balance it is, so that one is offered first
+        template = library.lookup(get_library_hash(), setup.screenshot_hashes[get_library_hash()]) \
+            if library is not None else None
+        if template is not None:
+            from firefly_bot.matching import BalanceIndex
+            width, height = setup.screenshot.size
+            recognised = BalanceIndex(balances).nearest(template.x * width * _OCR_SCALE,
+                                                        template.y * height * _OCR_SCALE)
+            balances.remove(recognised)
+            balances.insert(0, recognised)
+            message = i18n.t('setup.example_balance_recognised', name=setup.chosen_account.attributes.name,
+                             app=template.app or i18n.t('setup.example_app_unnamed'))
+            logger.info(f"Screenshot recognised from the template library as {template.app}")
+
         setup.balances = balances
         logger.info(f"Found {len(balances)} potential balances for account "
                     f"{setup.chosen_account.attributes.name}:{setup.chosen_account.id}")
@@ -120,26 +146,33 @@ def example(update: Update, context: CallbackContext) -> int:
                 callback_data=i
             )] for i, bal in enumerate(balances)]
 
-        update.message.reply_markdown(
-            i18n.t('setup.example_balance_found', name=setup.chosen_account.attributes.name),
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        reply_markdown(update.message, message, reply_markup=InlineKeyboardMarkup(keyboard))
         return BALANCE
 
 
-def balance_chosen(update: Update, context: CallbackContext) -> int:
+@instrumented()
+async def example_busy(update: Update, _: CallbackContext):
+    delete(update.message)
+    reply_text(update.message, i18n.t('setup.example_busy'))
+    logger.info(f'{update.message.from_user.name}:{update.message.from_user.id} sent another screenshot for '
+                f'setup while the last one is processing')
+
+
+@instrumented()
+async def balance_chosen(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     setup = context.user_data.get('setup')
     setup.chosen_balance = setup.balances[int(query.data)]
     logger.info(f"{update.effective_user.name}:{update.effective_user.id} selected balance for "
                 f"{setup.chosen_account.attributes.name}:{setup.chosen_account.id}")
-    return _check_relationships(update, context)
+    return await _check_relationships(update, context)
 
 
-def relation_chosen(update: Update, context: CallbackContext):
+@instrumented()
+async def relation_chosen(update: Update, context: CallbackContext):
     query = update.callback_query
-    query.answer()
+    await query.answer()
     setup = context.user_data.get('setup')
 
     if query.data == 'no':
@@ -147,10 +180,10 @@ def relation_chosen(update: Update, context: CallbackContext):
     else:
         setup.relationship = int(query.data)
         logger.info(f'{query.from_user.name}:{query.from_user.id} chose relationship {query.data}')
-    return _request_confirm(update, context)
+    return await _request_confirm(update, context)
 
 
-def _check_relationships(update: Update, context: CallbackContext) -> int:
+async def _check_relationships(update: Update, context: CallbackContext) -> int:
     setup = context.user_data.get('setup')
 
     if len(setup.sim_accounts) > 0:
@@ -164,22 +197,23 @@ def _check_relationships(update: Update, context: CallbackContext) -> int:
         keyboard.append(
             [InlineKeyboardButton(text=i18n.t('general.collection_none'), callback_data='no')]
         )
-        update.effective_message.reply_markdown(
-            i18n.t('setup.relationship_opportunity'),
+        reply_markdown(
+            update.effective_message, i18n.t('setup.relationship_opportunity'),
             reply_markup=InlineKeyboardMarkup(keyboard))
         return RELATED
     else:
-        return _request_confirm(update, context)
+        return await _request_confirm(update, context)
 
 
-def _request_confirm(update: Update, context: CallbackContext) -> int:
+async def _request_confirm(update: Update, context: CallbackContext) -> int:
     setup = context.user_data.get('setup')
 
     keyboard = [
         InlineKeyboardButton(text=i18n.t('general.confirm'), callback_data="1"),
         InlineKeyboardButton(text=i18n.t('general.cancel'), callback_data="0")
     ]
-    update.effective_message.reply_markdown(
+    reply_markdown(
+        update.effective_message,
         i18n.t('setup.setup_confirm',
                id=setup.chosen_account.id,
                name=setup.chosen_account.attributes.name,
@@ -189,52 +223,67 @@ def _request_confirm(update: Update, context: CallbackContext) -> int:
     return CONFIRM
 
 
-def confirm(update: Update, context: CallbackContext) -> int:
+def _contribute_template(setup: Setup):
+    """Adds the confirmed layout to the shared template library, if contributing to it is enabled."""
+    library = get_template_library()
+    if library is None or not config.get('bot').get('templates').get('contribute'):
+        return
+
+    width, height = setup.screenshot.size
+    image_hash = setup.screenshot_hashes[get_library_hash()]
+    try:
+        if library.add(LibraryTemplate(get_library_hash(), image_hash.hash.tolist(),
+                                       setup.chosen_balance.x / (width * _OCR_SCALE),
+                                       setup.chosen_balance.y / (height * _OCR_SCALE))):
+            logger.info(f'Added a template to the library, it now holds {len(library)} templates')
+    except OSError:
+        logger.exception('Could not write the template library')
+
+
+@instrumented()
+async def confirm(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
-    query.answer()
+    await query.answer()
     setup = context.user_data.get('setup')
     del context.user_data['setup']
 
     if query.data == "1":
-        user = _get_user_file(query.from_user.id)
-        accounts = user.get('accounts', dict())
-        relationship = user.get('relationship', 0)
-
-        if setup.relationship is None:
-            setup.relationship = relationship + 1
-            user['relationship'] = setup.relationship
-
-        accounts[setup.chosen_account.id] = {
+        primary, _ = _get_hash_cascade()[0]
+        setup.relationship = _add_user_account(query.from_user.id, {
             'id': int(setup.chosen_account.id),
             'name': setup.chosen_account.attributes.name,
             'image': {
                 'x': setup.chosen_balance.x,
                 'y': setup.chosen_balance.y,
-                'hash': setup.screenshot_hash.hash.tolist()
-            },
-            'relationship': setup.relationship
-        }
-        user['accounts'] = accounts
-        _write_user_file(query.from_user.id, user)
-
-        query.message.reply_text(i18n.t('setup.setup_complete'))
+                'width': setup.screenshot.size[0],
+                'height': setup.screenshot.size[1],
+                'hash': setup.screenshot_hashes[primary].hash.tolist(),
+                'hashes': {algorithm: h.hash.tolist() for algorithm, h in setup.screenshot_hashes.items()}
+            }
+        }, setup.relationship)
+
+        _contribute_template(setup)
+
+        reply_text(query.message, i18n.t('setup.setup_complete'))
         logger.info(f'{query.from_user.name}:{query.from_user.id} confirmed the account setup, '
                     f'writing {query.from_user.id}.json')
     elif query.data == "0":
-        query.message.reply_text(i18n.t('setup.setup_canceled'))
+        reply_text(query.message, i18n.t('setup.setup_canceled'))
         logger.info(f'{query.from_user.name}:{query.from_user.id} canceled the account setup')
 
     return ConversationHandler.END
 
 
-def cancel(update: Update, context: CallbackContext) -> int:
+@instrumented()
+async def cancel(update: Update, context: CallbackContext) -> int:
     del context.user_data['setup']
-    update.message.reply_text(i18n.t('setup.setup_canceled'))
+    reply_text(update.message, i18n.t('setup.setup_canceled'))
     logger.info(f'{update.message.from_user.name}:{update.message.from_user.id} canceled the account setup')
     return ConversationHandler.END
 
 
-def timeout(update: Update, context: CallbackContext) -> int:
+@instrumented()
+async def timeout(update: Update, context: CallbackContext) -> int:
     del context.user_data['setup']
     logger.info(f'{update.message.from_user.name}:{update.message.from_user.id} timed out account setup')
     return ConversationHandler.END
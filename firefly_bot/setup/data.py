@@ -1,11 +1,13 @@
 from dataclasses import dataclass
-from io import IOBase
-from typing import List
+from typing import TYPE_CHECKING, Dict, List
 
 from firefly_iii_client.model.account_read import AccountRead
-from imagehash import ImageHash
 
 from firefly_bot.data import Balance
+from firefly_bot.screenshot import Screenshot
+
+if TYPE_CHECKING:
+    from imagehash import ImageHash
 
 
 @dataclass
@@ -13,8 +15,8 @@ class Setup:
     accounts: List[AccountRead] = None
     chosen_account: AccountRead = None
 
-    screenshot: IOBase = None
-    screenshot_hash: ImageHash = None
+    screenshot: Screenshot = None
+    screenshot_hashes: Dict[str, 'ImageHash'] = None
 
     balances: List[Balance] = None
     chosen_balance: Balance = None
@@ -0,0 +1,33 @@
+import os
+import threading
+from typing import Union
+
+from firefly_bot.config import config
+from firefly_bot.storage.base import StorageDriver
+from firefly_bot.storage.file import FileDriver
+from firefly_bot.storage.sqlite import SqliteDriver
+
+# 'yaml' is what config.yml has always shipped with, although user files have always been JSON
+STORAGE_DRIVERS = {
+    'yaml': FileDriver,
+    'json': FileDriver,
+    'file': FileDriver,
+    'sqlite': SqliteDriver
+}
+
+_driver: Union[StorageDriver, None] = None
+_driver_lock = threading.Lock()
+
+
+def get_storage_driver() -> StorageDriver:
+    global _driver
+    with _driver_lock:
+        if _driver is None:
+            storage = config.get('bot').get('storage')
+            driver = STORAGE_DRIVERS[storage.get('driver', 'file')]
+            if driver is SqliteDriver:
+                database = storage.get('database') or os.path.join(storage.get('path'), 'firefly_bot.db')
+                _driver = SqliteDriver(database, storage.get('path'))
+            else:
+                _driver = FileDriver(storage.get('path'))
+        return _driver
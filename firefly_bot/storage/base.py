@@ -0,0 +1,57 @@
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Dict, Union
+
+if TYPE_CHECKING:
+    from firefly_bot.matching import TemplateSet
+
+
+class StorageDriver(ABC):
+    """Where users and their configured accounts are kept.
+
+    A user is exchanged as the same document the bot has always stored::
+
+        {'relationship': 2, 'accounts': {'<id>': {'id': ..., 'name': ..., 'image': {...}, 'relationship': ...}}}
+
+    Drivers should implement the account and relationship methods without rewriting the whole
+    document where they can.
+    """
+
+    @abstractmethod
+    def exists(self, user_id: int) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, user_id: int) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def write(self, user_id: int, user: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_templates(self, user_id: int) -> 'TemplateSet':
+        raise NotImplementedError
+
+    def get_accounts(self, user_id: int) -> Dict[str, dict]:
+        return self.get(user_id).get('accounts', dict())
+
+    @abstractmethod
+    def add_account(self, user_id: int, account: dict, relationship: Union[int, None] = None) -> int:
+        """Stores an account in an existing relationship, or a new one if ``relationship`` is None.
+
+        Returns the account's relationship.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_account(self, user_id: int, account_id: str) -> Union[dict, None]:
+        """Deletes an account, returning it or None if it did not exist."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_relationship(self, user_id: int, relationship: int) -> int:
+        """Deletes every account in a relationship, returning how many were deleted."""
+        raise NotImplementedError
+
+    def reset(self, user_id: int):
+        self.write(user_id, dict())
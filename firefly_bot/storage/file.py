@@ -0,0 +1,131 @@
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Tuple, Union
+
+from firefly_bot.storage.base import StorageDriver
+
+if TYPE_CHECKING:
+    from firefly_bot.matching import TemplateSet
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _CachedUser:
+    stat: Tuple[int, int]
+    user: dict
+    templates: 'TemplateSet'
+
+
+def _get_templates(user: dict) -> 'TemplateSet':
+    # Imported on first use, matching pulls in numpy
+    from firefly_bot.matching import TemplateSet
+    return TemplateSet(user.get('accounts', dict()).values())
+
+
+class FileDriver(StorageDriver):
+    """User documents stored as one JSON file per user, cached in memory.
+
+    Cached documents are invalidated when the file's mtime or size changes. Writes replace the file
+    atomically through a temporary file, and :meth:`lock` serialises read-modify-write cycles per user.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._cache: Dict[int, _CachedUser] = dict()
+        self._locks: Dict[int, threading.RLock] = dict()
+        self._locks_lock = threading.Lock()
+
+    def _user_file(self, user_id: int) -> str:
+        return os.path.join(self.path, f'{user_id}.json')
+
+    @staticmethod
+    def _stat(user_file: str) -> Tuple[int, int]:
+        st = os.stat(user_file)
+        return st.st_mtime_ns, st.st_size
+
+    def lock(self, user_id: int) -> threading.RLock:
+        with self._locks_lock:
+            return self._locks.setdefault(user_id, threading.RLock())
+
+    def exists(self, user_id: int) -> bool:
+        return os.path.exists(self._user_file(user_id))
+
+    def _load(self, user_id: int) -> _CachedUser:
+        user_file = self._user_file(user_id)
+        stat = self._stat(user_file)
+
+        cached = self._cache.get(user_id)
+        if cached is not None and cached.stat == stat:
+            return cached
+
+        with self.lock(user_id):
+            with open(user_file, 'r') as f:
+                user = json.load(f)
+
+            cached = _CachedUser(stat, user, _get_templates(user))
+            self._cache[user_id] = cached
+            logger.debug(f'Loaded user file {user_file}')
+            return cached
+
+    def get(self, user_id: int) -> dict:
+        # Handlers modify the document they're given before writing it back
+        return copy.deepcopy(self._load(user_id).user)
+
+    def get_templates(self, user_id: int) -> 'TemplateSet':
+        return self._load(user_id).templates
+
+    def write(self, user_id: int, user: dict):
+        user_file = self._user_file(user_id)
+        data = json.dumps(user)
+        # Cache exactly what a reload would give, e.g. integer keys become strings
+        user = json.loads(data)
+
+        with self.lock(user_id):
+            fd, tmp_file = tempfile.mkstemp(dir=self.path, prefix=f'.{user_id}.', suffix='.json')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, user_file)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+
+            self._cache[user_id] = _CachedUser(self._stat(user_file), user, _get_templates(user))
+
+    def add_account(self, user_id: int, account: dict, relationship: Union[int, None] = None) -> int:
+        with self.lock(user_id):
+            user = self.get(user_id)
+            if relationship is None:
+                relationship = user.get('relationship', 0) + 1
+                user['relationship'] = relationship
+
+            user.setdefault('accounts', dict())[str(account.get('id'))] = dict(account, relationship=relationship)
+            self.write(user_id, user)
+            return relationship
+
+    def delete_account(self, user_id: int, account_id: str) -> Union[dict, None]:
+        with self.lock(user_id):
+            user = self.get(user_id)
+            account = user.get('accounts', dict()).pop(str(account_id), None)
+            if account is not None:
+                self.write(user_id, user)
+            return account
+
+    def delete_relationship(self, user_id: int, relationship: int) -> int:
+        with self.lock(user_id):
+            user = self.get(user_id)
+            accounts = user.get('accounts', dict())
+            deleted = [k for k, account in accounts.items() if account.get('relationship') == relationship]
+            for k in deleted:
+                del accounts[k]
+
+            self.write(user_id, user)
+            return len(deleted)
@@ -0,0 +1,217 @@
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+from firefly_bot.storage.base import StorageDriver
+
+if TYPE_CHECKING:
+    from firefly_bot.matching import TemplateSet
+
+logger = logging.getLogger(__name__)
+
+# Stored account hashes without a named algorithm, kept as ``image.hash`` in user documents
+_LEGACY_HASH = 'hash'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    relationship INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    relationship INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    PRIMARY KEY (user_id, id)
+);
+CREATE INDEX IF NOT EXISTS accounts_relationship ON accounts (user_id, relationship);
+CREATE TABLE IF NOT EXISTS hashes (
+    user_id INTEGER NOT NULL,
+    account_id INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    bits BLOB NOT NULL,
+    PRIMARY KEY (user_id, account_id, algorithm),
+    FOREIGN KEY (user_id, account_id) REFERENCES accounts (user_id, id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY,
+    applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+'''
+
+
+def _pack_hash(hash_bits: List) -> Tuple[str, bytes]:
+    import numpy as np
+
+    bits = np.asarray(hash_bits, dtype=bool)
+    return ','.join(str(d) for d in bits.shape), np.packbits(bits.flatten()).tobytes()
+
+
+def _unpack_hash(shape: str, packed: bytes) -> List:
+    import numpy as np
+
+    shape = tuple(int(d) for d in shape.split(','))
+    bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=int(np.prod(shape)))
+    return bits.astype(bool).reshape(shape).tolist()
+
+
+class SqliteDriver(StorageDriver):
+    """Users, accounts, relationships and packed image hashes kept in indexed SQLite tables.
+
+    User JSON files found in ``path`` are imported the first time the database is opened.
+    """
+
+    def __init__(self, database: str, path: str):
+        self.database = database
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._templates: Dict[int, 'TemplateSet'] = dict()
+
+        with self._connection() as conn:
+            conn.executescript(_SCHEMA)
+        self._migrate_json_files()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.database)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA foreign_keys = ON')
+            self._local.conn = conn
+        return conn
+
+    def _migrate_json_files(self):
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM migrations WHERE name = 'json_files'").fetchone():
+            return
+
+        user_files = glob.glob(os.path.join(self.path, '*.json'))
+        with self._write_lock, conn:
+            for user_file in user_files:
+                user_id = os.path.splitext(os.path.basename(user_file))[0]
+                if not user_id.isdigit():
+                    continue
+
+                with open(user_file, 'r') as f:
+                    self._write(conn, int(user_id), json.load(f))
+            conn.execute("INSERT INTO migrations (name) VALUES ('json_files')")
+        logger.info(f'Imported {len(user_files)} user files into {self.database}')
+
+    def exists(self, user_id: int) -> bool:
+        return self._connection().execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+
+    def get(self, user_id: int) -> dict:
+        conn = self._connection()
+        row = conn.execute('SELECT relationship FROM users WHERE id = ?', (user_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f'No user {user_id} in {self.database}')
+
+        user = dict()
+        if row['relationship']:
+            user['relationship'] = row['relationship']
+
+        accounts = self.get_accounts(user_id)
+        if accounts:
+            user['accounts'] = accounts
+        return user
+
+    def get_accounts(self, user_id: int) -> Dict[str, dict]:
+        conn = self._connection()
+        accounts = dict()
+        for row in conn.execute('SELECT * FROM accounts WHERE user_id = ? ORDER BY rowid', (user_id,)):
+            image = {'x': row['x'], 'y': row['y']}
+            if row['width'] is not None:
+                image.update(width=row['width'], height=row['height'])
+
+            accounts[str(row['id'])] = {
+                'id': row['id'],
+                'name': row['name'],
+                'image': image,
+                'relationship': row['relationship']
+            }
+
+        for row in conn.execute('SELECT * FROM hashes WHERE user_id = ?', (user_id,)):
+            image = accounts[str(row['account_id'])]['image']
+            image_hash = _unpack_hash(row['shape'], row['bits'])
+            if row['algorithm'] == _LEGACY_HASH:
+                image['hash'] = image_hash
+            else:
+                image.setdefault('hashes', dict())[row['algorithm']] = image_hash
+        return accounts
+
+    def get_templates(self, user_id: int) -> 'TemplateSet':
+        if user_id not in self._templates:
+            from firefly_bot.matching import TemplateSet
+            self._templates[user_id] = TemplateSet(self.get_accounts(user_id).values())
+        return self._templates[user_id]
+
+    def _insert_account(self, conn: sqlite3.Connection, user_id: int, account: dict):
+        image = account.get('image')
+        conn.execute(
+            'INSERT INTO accounts (user_id, id, name, relationship, x, y, width, height) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (user_id, int(account.get('id')), account.get('name'), account.get('relationship'),
+             image.get('x'), image.get('y'), image.get('width'), image.get('height'))
+        )
+
+        hashes = dict(image.get('hashes', dict()))
+        if 'hash' in image:
+            hashes[_LEGACY_HASH] = image.get('hash')
+        conn.executemany(
+            'INSERT INTO hashes (user_id, account_id, algorithm, shape, bits) VALUES (?, ?, ?, ?, ?)',
+            [(user_id, int(account.get('id')), algorithm, *_pack_hash(bits)) for algorithm, bits in hashes.items()]
+        )
+
+    def _write(self, conn: sqlite3.Connection, user_id: int, user: dict):
+        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.execute('INSERT INTO users (id, relationship) VALUES (?, ?)', (user_id, user.get('relationship', 0)))
+        for account in user.get('accounts', dict()).values():
+            self._insert_account(conn, user_id, account)
+        self._templates.pop(user_id, None)
+
+    def write(self, user_id: int, user: dict):
+        conn = self._connection()
+        with self._write_lock, conn:
+            self._write(conn, user_id, user)
+
+    def add_account(self, user_id: int, account: dict, relationship: Union[int, None] = None) -> int:
+        conn = self._connection()
+        with self._write_lock, conn:
+            if relationship is None:
+                conn.execute('UPDATE users SET relationship = relationship + 1 WHERE id = ?', (user_id,))
+                relationship = conn.execute('SELECT relationship FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+
+            conn.execute('DELETE FROM accounts WHERE user_id = ? AND id = ?', (user_id, int(account.get('id'))))
+            self._insert_account(conn, user_id, dict(account, relationship=relationship))
+            self._templates.pop(user_id, None)
+        return relationship
+
+    def delete_account(self, user_id: int, account_id: str) -> Union[dict, None]:
+        account = self.get_accounts(user_id).get(str(account_id))
+        if account is None:
+            return None
+
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute('DELETE FROM accounts WHERE user_id = ? AND id = ?', (user_id, int(account_id)))
+            self._templates.pop(user_id, None)
+        return account
+
+    def delete_relationship(self, user_id: int, relationship: int) -> int:
+        conn = self._connection()
+        with self._write_lock, conn:
+            deleted = conn.execute('DELETE FROM accounts WHERE user_id = ? AND relationship = ?',
+                                   (user_id, relationship)).rowcount
+            self._templates.pop(user_id, None)
+        return deleted
@@ -1,70 +1,165 @@
-import json
-import math
-import os
-from io import IOBase
-from typing import Iterable, List
-
-import cv2 as cv
-import imagehash
-import numpy as np
-from PIL import Image
-from price_parser import Price
-from pytesseract import pytesseract
+import hashlib
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Sequence, Tuple, Union
 
+from telegram import PhotoSize
+
+from firefly_bot.cache import TTLCache
 from firefly_bot.config import config
-from firefly_bot.data import Balance
+from firefly_bot.data import AccountMatch, ScreenshotResult
+from firefly_bot.metrics import instrumented, observe
+from firefly_bot.screenshot import Screenshot
+from firefly_bot.storage import get_storage_driver
+
+if TYPE_CHECKING:
+    from imagehash import ImageHash
+
+    from firefly_bot.matching import TemplateSet
+
+# Screenshots are upscaled before OCR, balance locations are reported in this upscaled space
+_OCR_SCALE = 2
+
+# Smallest side, in pixels, of the photo rendition downloaded for matching screenshots to accounts
+_THUMBNAIL_SIZE = 320
+
+_screenshot_results: Union[TTLCache, None] = None
+
+
+def _user_exists(user_id: int) -> bool:
+    return get_storage_driver().exists(user_id)
 
 
 def _get_user_file(user_id: int) -> dict:
-    user_file = os.path.join(config.get('bot').get('storage').get('path'), f'{user_id}.json')
-    with open(user_file, 'r') as f:
-        return json.load(f)
+    return get_storage_driver().get(user_id)
 
 
 def _write_user_file(user_id: int, obj: dict):
-    user_file = os.path.join(config.get('bot').get('storage').get('path'), f'{user_id}.json')
-    with open(user_file, 'w') as f:
-        json.dump(obj, f)
-
-
-def _get_similar_accounts_from_screenshot(screenshot: IOBase, accounts: List) -> List:
-    diffs = []
-    for account in accounts:
-        img = Image.open(screenshot)
-        image_hash_func = getattr(imagehash, config.get('bot').get('screenshots').get('hash'))
-        image_hash = image_hash_func(img)
-        original_image_hash = imagehash.ImageHash(np.array(account.get('image').get('hash')))
-        diffs.append(image_hash - original_image_hash)
-
-    screenshot.seek(0)
-    return [accounts[i]
-            for i, diff in enumerate(diffs)
-            if diff == min(diffs) and diff < config.get('bot').get('screenshots').get('threshold')]
-
-
-def _get_nearest_balance_from_screenshot(screenshot: IOBase, x: int, y: int):
-    balances = list(_get_balances_from_screenshot(screenshot))
-    dists = [math.sqrt(math.pow(b.x - x, 2) + math.pow(b.y - y, 2))
-             for b in balances]
-    return balances[dists.index(min(dists))]
-
-
-def _get_balances_from_screenshot(screenshot: IOBase) -> Iterable[Balance]:
-    np_bytes = np.asarray(bytearray(screenshot.read()), dtype=np.uint8)
-    img = cv.imdecode(np_bytes, cv.IMREAD_GRAYSCALE)
-
-    img_scaled = cv.resize(img, None, fx=2, fy=2)
-    ret1, th1 = cv.threshold(img_scaled, 0, 255, cv.THRESH_BINARY_INV + cv.THRESH_OTSU)
-    screenshot_data = pytesseract.image_to_data(th1, config='--psm 11', output_type=pytesseract.Output.DICT)
-
-    prices = [Price.fromstring(s) for s in screenshot_data.get('text')]
-    potential_balances = [
-        Balance(
-            screenshot_data['left'][i],
-            screenshot_data['top'][i],
-            prices[i]
-        ) for i in range(len(prices))]
-
-    def empty_price_filter(bal):
-        return bal.price.amount is not None and bal.price.currency is not None
-    return filter(empty_price_filter, potential_balances)
+    get_storage_driver().write(user_id, obj)
+
+
+def _get_user_templates(user_id: int) -> 'TemplateSet':
+    return get_storage_driver().get_templates(user_id)
+
+
+def _get_user_accounts(user_id: int) -> Dict[str, dict]:
+    return get_storage_driver().get_accounts(user_id)
+
+
+def _add_user_account(user_id: int, account: dict, relationship: Union[int, None] = None) -> int:
+    return get_storage_driver().add_account(user_id, account, relationship)
+
+
+def _delete_user_account(user_id: int, account_id: str) -> Union[dict, None]:
+    return get_storage_driver().delete_account(user_id, account_id)
+
+
+def _delete_user_relationship(user_id: int, relationship: int) -> int:
+    return get_storage_driver().delete_relationship(user_id, relationship)
+
+
+def _reset_user(user_id: int):
+    get_storage_driver().reset(user_id)
+
+
+def _get_thumbnail(photo: Sequence[PhotoSize]) -> PhotoSize:
+    """Picks the smallest rendition of a photo that is still large enough to hash."""
+    size = config.get('bot').get('screenshots').get('thumbnail', _THUMBNAIL_SIZE)
+    return next((p for p in photo if min(p.width, p.height) >= size), photo[-1])
+
+
+@instrumented('telegram.download')
+async def _download_screenshot(photo_size: PhotoSize) -> Screenshot:
+    photo_file = await photo_size.get_file()
+    # Wrapped as downloaded, decoding reads the bytearray in place
+    return Screenshot(await photo_file.download_as_bytearray())
+
+
+def _get_screenshot_digest(screenshot: Screenshot) -> str:
+    return hashlib.blake2b(screenshot.data, digest_size=16).hexdigest()
+
+
+def _get_screenshot_results() -> TTLCache:
+    global _screenshot_results
+    if _screenshot_results is None:
+        screenshots = config.get('bot').get('screenshots')
+        _screenshot_results = TTLCache(int(screenshots.get('cache_size', 256)),
+                                       float(screenshots.get('cache_ttl', 86400)))
+    return _screenshot_results
+
+
+def _get_screenshot_result(user_id: int, *keys: str) -> Union[ScreenshotResult, None]:
+    """Looks up what was already worked out from a screenshot by its file_unique_id or content digest."""
+    results = _get_screenshot_results()
+    return next((r for r in (results.get((user_id, k)) for k in keys) if r is not None), None)
+
+
+def _put_screenshot_result(user_id: int, result: ScreenshotResult, *keys: str):
+    for k in keys:
+        _get_screenshot_results().put((user_id, k), result)
+
+
+def _get_hash_cascade() -> List[Tuple[str, int]]:
+    """The hash algorithms screenshots are matched with, each with its threshold, cheapest first.
+
+    The configured ``hash`` narrows the candidates, and every ``cascade`` stage after it re-ranks
+    only the accounts that are left.
+    """
+    screenshots = config.get('bot').get('screenshots')
+    cascade = [(screenshots.get('hash'), int(screenshots.get('threshold')))]
+    for stage in screenshots.get('cascade') or []:
+        cascade.append((stage.get('hash'), int(stage.get('threshold'))))
+    return cascade
+
+
+def _narrow_matches(shortlist: Union[List[AccountMatch], None], templates: 'TemplateSet', stage: int,
+                    image_hash: 'ImageHash') -> List[AccountMatch]:
+    """Keeps the accounts left from the previous stages of the cascade that also pass stage ``stage``.
+
+    Only this is timed as the match stage, labelled with the stage's algorithm, the hashes it is
+    given are timed where they are downloaded and computed.
+    """
+    start = time.perf_counter()
+    algorithm, threshold = _get_hash_cascade()[stage]
+    matrix = templates.matrix(algorithm, legacy=stage == 0)
+    matches = [m for m in matrix.rank(image_hash) if m.distance < threshold]
+    if shortlist is not None:
+        candidates = {int(m.account.get('id')) for m in shortlist}
+        matches = [m for m in matches if int(m.account.get('id')) in candidates]
+        if not matches:
+            # Accounts with no hash for this stage can't be checked by it, they are only kept when the
+            # earlier stages matched them at least as well as any account that was checked and failed
+            failed = min((m.distance for m in shortlist if int(m.account.get('id')) in matrix.ids), default=None)
+            matches = [m for m in shortlist if int(m.account.get('id')) not in matrix.ids
+                       and (failed is None or m.distance <= failed)]
+    observe('match', time.perf_counter() - start, hashed=algorithm)
+    return matches
+
+
+def _get_similar_accounts_from_screenshot(get_hash: Callable[[str], 'ImageHash'],
+                                          templates: 'TemplateSet') -> List[AccountMatch]:
+    """Matches a screenshot against the user's accounts through every stage of the hash cascade.
+
+    ``get_hash`` is only called for the algorithms a stage actually needs, so a screenshot that
+    matches nothing in the cheap first stage is never hashed again. Accounts set up before a stage
+    was configured have no hash for it and are only kept if no other account passes that stage,
+    and none that failed it had matched better before.
+    """
+    shortlist = None
+    for stage, (algorithm, _) in enumerate(_get_hash_cascade()):
+        shortlist = _narrow_matches(shortlist, templates, stage, get_hash(algorithm))
+        if not shortlist:
+            return []
+
+    return [m for m in shortlist if m.distance == shortlist[0].distance]
+
+
+async def _await_similar_accounts_from_screenshot(get_hash: Callable[[str], Awaitable['ImageHash']],
+                                                  templates: 'TemplateSet') -> List[AccountMatch]:
+    """:func:`_get_similar_accounts_from_screenshot` for hashes that have to be downloaded and computed first."""
+    shortlist = None
+    for stage, (algorithm, _) in enumerate(_get_hash_cascade()):
+        shortlist = _narrow_matches(shortlist, templates, stage, await get_hash(algorithm))
+        if not shortlist:
+            return []
+
+    return [m for m in shortlist if m.distance == shortlist[0].distance]
@@ -0,0 +1,201 @@
+"""The CPU heavy screenshot steps, image hashing and OCR.
+
+Only the worker processes import this module, so the bot itself starts without loading OpenCV,
+Tesseract or the image hashing libraries. Handlers run these functions by name with
+:func:`firefly_bot.workers.run_in_worker`.
+"""
+import re
+from typing import Dict, List, NamedTuple, Sequence, Tuple, Union
+
+import cv2 as cv
+import imagehash
+import numpy as np
+from price_parser import Price
+
+from firefly_bot.config import config
+from firefly_bot.data import Balance
+from firefly_bot.matching import BalanceIndex
+from firefly_bot.ocr import get_ocr_backend
+from firefly_bot.screenshot import Screenshot
+from firefly_bot.utils import _OCR_SCALE
+
+# Words that may be part of a price: anything with a digit, or short enough to be a currency symbol or code
+_PRICE_TOKEN = re.compile(r'\d|^\S{1,3}$')
+
+# Most words a price split up by Tesseract is put back together from, e.g. "1", "234,56" and "€"
+_MAX_MERGED_TOKENS = 4
+
+# Sizes of the OCR windows tried around a stored balance, as fractions of the screenshot width. A window
+# reaches half its size left of the balance's top-left corner, a quarter above and half below, and since
+# balances run rightwards from that corner, all the way to the right edge of the screenshot.
+_ROI_WINDOWS = [0.25, 0.5]
+
+# Distance, in pixels of the image OCR'd, within which a word is taken to touch the edge of a crop
+_CROP_EDGE = 2
+
+
+class _Token(NamedTuple):
+    """A word from Tesseract's data."""
+    text: str
+    left: int
+    top: int
+    width: int
+    height: int
+    conf: float
+
+
+def _get_screenshot_hash(screenshot: Screenshot, algorithm: Union[str, None] = None) -> imagehash.ImageHash:
+    image_hash_func = getattr(imagehash, algorithm or config.get('bot').get('screenshots').get('hash'))
+    return image_hash_func(screenshot.image)
+
+
+def _get_screenshot_hashes(screenshot: Screenshot, algorithms: Sequence[str]) -> Dict[str, imagehash.ImageHash]:
+    img = screenshot.image
+    return {algorithm: getattr(imagehash, algorithm)(img) for algorithm in algorithms}
+
+
+def _get_hashes_and_balances_from_screenshot(
+        screenshot: Screenshot, thumbnail: Screenshot,
+        algorithms: Sequence[str]) -> Tuple[Dict[str, imagehash.ImageHash], List[Balance]]:
+    """Hashes the thumbnail and OCRs the screenshot in one go, decoding once when they're the same photo."""
+    return _get_screenshot_hashes(thumbnail, algorithms), _get_balances_from_screenshot(screenshot)
+
+
+def _get_nearest_balances_from_screenshot(screenshot: Screenshot, images: List[Dict]) -> List[Union[Balance, None]]:
+    """Finds the balance nearest to each account's stored balance location with as few OCR passes as possible.
+
+    A single window enclosing every account's location is OCR'd at first, growing it for each of
+    the configured ``roi`` fractions of the screenshot width, and every account is answered from
+    the same pass. Words the window cuts through are ignored, as a cut off amount still parses,
+    so a balance that doesn't fit makes the window grow. Only if some account has no balance near
+    its location is the full page OCR'd.
+    """
+    if not images:
+        return []
+
+    img = screenshot.gray
+    height, width = img.shape
+
+    locations = []
+    for image in images:
+        # Stored locations are in the upscaled OCR space of the screenshot the account was set up with
+        x, y = image.get('x') / _OCR_SCALE, image.get('y') / _OCR_SCALE
+        if image.get('width') and image.get('height'):
+            x *= width / image.get('width')
+            y *= height / image.get('height')
+        locations.append((x, y))
+
+    for fraction in config.get('bot').get('screenshots').get('roi', _ROI_WINDOWS):
+        size = fraction * width
+        windows = [(max(int(x - size / 2), 0), max(int(y - size / 4), 0), width, min(int(y + size / 2), height))
+                   for x, y in locations]
+        left, top = min(w[0] for w in windows), min(w[1] for w in windows)
+        right, bottom = max(w[2] for w in windows), max(w[3] for w in windows)
+        if left >= right or top >= bottom:
+            continue
+
+        index = BalanceIndex(_get_balances_from_image(img[top:bottom, left:right], left, top, (height, width)))
+        balances = [index.nearest(x * _OCR_SCALE, y * _OCR_SCALE, tuple(v * _OCR_SCALE for v in window))
+                    for (x, y), window in zip(locations, windows)]
+        if all(balance is not None for balance in balances):
+            return balances
+
+    index = BalanceIndex(_get_balances_from_image(img))
+    return [index.nearest(x * _OCR_SCALE, y * _OCR_SCALE) for x, y in locations]
+
+
+def _get_balances_from_screenshot(screenshot: Screenshot) -> List[Balance]:
+    return _get_balances_from_image(screenshot.gray)
+
+
+def _preprocess_image(img: np.ndarray) -> np.ndarray:
+    img_scaled = cv.resize(img, None, fx=_OCR_SCALE, fy=_OCR_SCALE)
+    ret1, th1 = cv.threshold(img_scaled, 0, 255, cv.THRESH_BINARY_INV + cv.THRESH_OTSU)
+    return th1
+
+
+def _get_balances_from_image(img: np.ndarray, left: int = 0, top: int = 0,
+                             shape: Union[Tuple[int, int], None] = None) -> List[Balance]:
+    """OCRs balances from a grayscale image, which may be a crop whose top-left corner is at ``left``/``top``.
+
+    For a crop of a screenshot of the given ``shape``, words touching an edge the crop cut the
+    screenshot at are left out, as they may have lost part of their text. Balance locations are
+    returned in the upscaled OCR space of the whole screenshot.
+    """
+    ocr_backend = get_ocr_backend(config.get('bot').get('screenshots').get('ocr', 'pytesseract'))
+    preprocessed = _preprocess_image(img)
+
+    bounds = None
+    if shape is not None:
+        (crop_height, crop_width), (ocr_height, ocr_width) = img.shape, preprocessed.shape
+        bounds = (_CROP_EDGE if left > 0 else -1, _CROP_EDGE if top > 0 else -1,
+                  ocr_width - _CROP_EDGE if left + crop_width < shape[1] else ocr_width + 1,
+                  ocr_height - _CROP_EDGE if top + crop_height < shape[0] else ocr_height + 1)
+    return _get_balances_from_data(ocr_backend.image_to_data(preprocessed), left, top, bounds)
+
+
+def _get_price_tokens(screenshot_data: Dict[str, List],
+                      bounds: Union[Tuple[int, int, int, int], None] = None) -> List[_Token]:
+    tokens = [
+        _Token(text, screenshot_data['left'][i], screenshot_data['top'][i], screenshot_data['width'][i],
+               screenshot_data['height'][i], float(screenshot_data['conf'][i]))
+        for i, text in enumerate(screenshot_data.get('text')) if _PRICE_TOKEN.search(text)
+    ]
+    if bounds is None:
+        return tokens
+
+    left, top, right, bottom = bounds
+    return [t for t in tokens
+            if t.left > left and t.top > top and t.left + t.width < right and t.top + t.height < bottom]
+
+
+def _are_adjacent(a: _Token, b: _Token) -> bool:
+    """Whether ``b`` follows ``a`` on the same line, no more than about a word space apart."""
+    height = max(a.height, b.height)
+    gap = b.left - (a.left + a.width)
+    return -height / 2 <= gap <= height and abs((a.top + a.height / 2) - (b.top + b.height / 2)) <= height / 2
+
+
+def _get_balances_from_data(screenshot_data: Dict[str, List], left: int = 0, top: int = 0,
+                            bounds: Union[Tuple[int, int, int, int], None] = None) -> List[Balance]:
+    """Parses balances from OCR data of an image upscaled by ``_OCR_SCALE``.
+
+    Only words that could be part of a price are parsed. Words that hold just a currency or just an
+    amount are joined with the words that follow them on the same line, so a price Tesseract split
+    into e.g. "£" and "1,234.56" is still found. With ``(left, top, right, bottom)`` ``bounds``, in
+    pixels of the image OCR'd, words not strictly within them are skipped too.
+    """
+    def balance(tokens: List[_Token], price: Price) -> Balance:
+        return Balance(tokens[0].left + left * _OCR_SCALE, tokens[0].top + top * _OCR_SCALE,
+                       price, min(t.conf for t in tokens))
+
+    def is_complete(price: Price) -> bool:
+        return price.amount is not None and price.currency is not None
+
+    balances = []
+    partial = []
+    for token in sorted(_get_price_tokens(screenshot_data, bounds), key=lambda t: t.left):
+        price = Price.fromstring(token.text)
+        if is_complete(price):
+            balances.append(balance([token], price))
+            continue
+
+        group = next((g for g in partial if _are_adjacent(g[-1], token)), None)
+        if group is None:
+            partial.append([token])
+            continue
+
+        group.append(token)
+        price = Price.fromstring(' '.join(t.text for t in group))
+        if is_complete(price):
+            balances.append(balance(group, price))
+            partial.remove(group)
+        elif len(group) >= _MAX_MERGED_TOKENS:
+            partial.remove(group)
+    return balances
+
+
+def _warm_up():
+    """Loads the OCR backend and Tesseract's model on a blank image, so the first screenshot doesn't wait for them."""
+    ocr_backend = get_ocr_backend(config.get('bot').get('screenshots').get('ocr', 'pytesseract'))
+    ocr_backend.image_to_data(np.full((64, 64), 255, dtype=np.uint8))
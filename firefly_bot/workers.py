@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Tuple, Union
+
+import i18n
+from telegram import Update
+
+from firefly_bot.config import config, init_config
+from firefly_bot.metrics import observe, track_queue
+from firefly_bot.outbox import reply_text
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPoolFull(Exception):
+    pass
+
+
+class WorkerPool:
+    """Process pool for the CPU heavy screenshot steps (image hashing and OCR).
+
+    At most ``processes`` jobs run at once and at most ``queue_size`` more wait behind them,
+    submitting beyond that raises :class:`WorkerPoolFull` so handlers can turn users away
+    instead of piling up work.
+    """
+
+    def __init__(self, processes: int, queue_size: int, warm_up: bool = False):
+        self.processes = processes
+        self.queue_size = queue_size
+        self._executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(warm_up,))
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.processes + self.queue_size
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, fn: Callable, *args) -> Tuple[Future, int]:
+        """Submits a job, returning its future and its position in the queue (0 if it runs immediately)."""
+        with self._lock:
+            if self._pending >= self.capacity:
+                raise WorkerPoolFull()
+            position = max(self._pending - self.processes + 1, 0)
+            self._pending += 1
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._done(None)
+            raise
+
+        future.add_done_callback(self._done)
+        return future, position
+
+    def start(self):
+        """Starts every worker process now rather than on the first screenshot, without waiting for them."""
+        for _ in range(self.processes):
+            self._executor.submit(int)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self, _: Union[Future, None]):
+        with self._lock:
+            self._pending -= 1
+
+
+def _init_worker(warm_up: bool):
+    init_config()
+    if warm_up:
+        from firefly_bot import vision
+        # A worker that can't warm up still takes jobs, they fail the way they would have anyway
+        try:
+            vision._warm_up()
+        except Exception:
+            logger.exception(f'Worker {os.getpid()} failed warming up')
+
+
+def _run_vision(name: str, *args):
+    # Only worker processes import the image processing libraries, the bot process never does
+    from firefly_bot import vision
+    return getattr(vision, name)(*args)
+
+
+_pool: Union[WorkerPool, None] = None
+_pool_lock = threading.Lock()
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_worker_pool() -> WorkerPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = config.get('bot').get('workers', dict())
+            processes = int(workers.get('processes') or 0) or _available_cores()
+            queue_size = int(workers.get('queue', processes * 2))
+            _pool = WorkerPool(processes, queue_size, bool(workers.get('warm_up', False)))
+            track_queue('workers', lambda: _pool.pending)
+            logger.info(f'Started screenshot worker pool with {processes} processes, queue of {queue_size}')
+        return _pool
+
+
+async def run_in_worker(update: Union[Update, None], fn: str, *args):
+    """Runs the :mod:`firefly_bot.vision` function named ``fn`` in the worker pool and awaits the result.
+
+    The user is told their position when the job has to wait for a free worker, unless ``update``
+    is None, e.g. for jobs that are part of a batch. Raises :class:`WorkerPoolFull` when the queue
+    is already full.
+    """
+    # Recorded here rather than in the worker process, including the time spent queued
+    stage = f"worker.{fn.lstrip('_')}"
+    start = time.perf_counter()
+    try:
+        future, position = get_worker_pool().submit(_run_vision, fn, *args)
+    except WorkerPoolFull:
+        observe(stage, 0, 'rejected')
+        raise
+
+    if position > 0 and update is not None:
+        logger.info(f'User {update.effective_user.name}:{update.effective_user.id} queued at position {position}')
+        reply_text(update.effective_message, i18n.t('general.queued', position=position), status='queued')
+
+    # Hashing may be asked for a specific algorithm of the cascade rather than the configured one
+    hashed = fn == '_get_screenshot_hash' and (args[1] if len(args) > 1 and args[1] else True)
+    try:
+        result = await asyncio.wrap_future(future)
+    except Exception:
+        observe(stage, time.perf_counter() - start, 'error', hashed=hashed)
+        raise
+    observe(stage, time.perf_counter() - start, hashed=hashed)
+    return result
@@ -8,5 +8,10 @@ setuptools.setup(
     description='Telegram bot for importing screenshots into FireflyIII',
     license='MIT',
     url='https://github.com/ben-pearce/firefly-screenshot-bot',
-    packages=['firefly_bot', 'firefly_bot.setup', 'firefly_bot.manage', 'firefly_bot.balance']
+    packages=['firefly_bot', 'firefly_bot.setup', 'firefly_bot.manage', 'firefly_bot.balance', 'firefly_bot.storage'],
+    entry_points={
+        'console_scripts': [
+            'firefly-bot-import=firefly_bot.importer:main'
+        ]
+    }
 )
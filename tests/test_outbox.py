@@ -0,0 +1,207 @@
+import asyncio
+import time
+from typing import List, Sequence, Tuple
+
+from telegram import Chat
+from telegram.error import BadRequest, RetryAfter
+
+from firefly_bot.outbox import Outbox
+
+# Intervals are kept to a tenth of a second so the suite stays quick, timings are checked to within this
+_SLACK = 0.05
+
+PRIVATE = Chat(1, Chat.PRIVATE)
+OTHER = Chat(2, Chat.PRIVATE)
+GROUP = Chat(3, Chat.GROUP)
+
+
+class _Recorder:
+    """Fake sends that record when each one reached Telegram, in seconds since the recorder was made."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.sent: List[Tuple[str, float]] = []
+        self.attempts: List[str] = []
+
+    def send(self, label: str, failures: Sequence[Exception] = ()):
+        failures = list(failures)
+
+        async def send():
+            self.attempts.append(label)
+            if failures:
+                raise failures.pop(0)
+            self.sent.append((label, time.monotonic() - self.start))
+        return send
+
+    @property
+    def labels(self) -> List[str]:
+        return [label for label, _ in self.sent]
+
+    def at(self, label: str) -> float:
+        return next(at for sent, at in self.sent if sent == label)
+
+
+def _outbox(rate: float = 100, chat_rate: float = 10, group_rate: float = 600, retries: int = 3) -> Outbox:
+    return Outbox(rate, chat_rate, group_rate, retries)
+
+
+def test_chat_rate():
+    async def run():
+        outbox, recorder = _outbox(chat_rate=10), _Recorder()
+        for label in 'abc':
+            outbox.post(PRIVATE, recorder.send(label))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.labels == ['a', 'b', 'c']
+    assert recorder.at('a') < _SLACK
+    assert 0.1 <= recorder.at('b') < 0.1 + _SLACK
+    assert 0.2 <= recorder.at('c') < 0.2 + _SLACK
+
+
+def test_group_rate():
+    async def run():
+        outbox, recorder = _outbox(group_rate=300), _Recorder()
+        outbox.post(GROUP, recorder.send('a'))
+        outbox.post(GROUP, recorder.send('b'))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert 0.2 <= recorder.at('b') < 0.2 + _SLACK
+
+
+def test_chats_are_not_held_up_by_each_other():
+    async def run():
+        outbox, recorder = _outbox(chat_rate=2), _Recorder()
+        outbox.post(PRIVATE, recorder.send('a1'))
+        outbox.post(PRIVATE, recorder.send('a2'))
+        outbox.post(OTHER, recorder.send('b1'))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.labels == ['a1', 'b1', 'a2']
+    assert recorder.at('b1') < _SLACK
+    assert 0.5 <= recorder.at('a2') < 0.5 + _SLACK
+
+
+def test_global_rate():
+    async def run():
+        outbox, recorder = _outbox(rate=10), _Recorder()
+        for i in range(4):
+            outbox.post(Chat(10 + i, Chat.PRIVATE), recorder.send(str(i)))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.labels == ['0', '1', '2', '3']
+    for i, (_, at) in enumerate(recorder.sent):
+        assert 0.1 * i <= at < 0.1 * i + _SLACK
+
+
+def test_retry_after_pauses_every_chat():
+    async def run():
+        outbox, recorder = _outbox(), _Recorder()
+        outbox.post(PRIVATE, recorder.send('a', [RetryAfter(0.3)]))
+        # Posted once the 429 came back, so the global pause is in force by the time it is sent
+        await asyncio.sleep(0.05)
+        outbox.post(OTHER, recorder.send('b'))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert sorted(recorder.attempts) == ['a', 'a', 'b']
+    assert 0.3 <= recorder.at('a') < 0.3 + _SLACK
+    assert 0.3 <= recorder.at('b') < 0.3 + _SLACK
+
+
+def test_gives_up_after_retries():
+    async def run():
+        outbox, recorder = _outbox(retries=2), _Recorder()
+        outbox.post(PRIVATE, recorder.send('a', [RetryAfter(0.1)] * 5))
+        outbox.post(PRIVATE, recorder.send('b'))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.attempts == ['a', 'a', 'a', 'b']
+    assert recorder.labels == ['b']
+
+
+def test_errors_drop_only_the_message():
+    async def run():
+        outbox, recorder = _outbox(), _Recorder()
+        outbox.post(PRIVATE, recorder.send('a', [BadRequest("Can't parse entities")]))
+        outbox.post(PRIVATE, recorder.send('b', [ValueError()]))
+        outbox.post(PRIVATE, recorder.send('c'))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.attempts == ['a', 'b', 'c']
+    assert recorder.labels == ['c']
+
+
+def test_status_messages_coalesce():
+    async def run():
+        outbox, recorder = _outbox(), _Recorder()
+        outbox.post(PRIVATE, recorder.send('reply'))
+        outbox.post(PRIVATE, recorder.send('queued 3'), status='queued')
+        outbox.post(PRIVATE, recorder.send('queued 2'), status='queued')
+        outbox.post(PRIVATE, recorder.send('other'), status='other')
+        outbox.post(PRIVATE, recorder.send('queued 1'), status='queued')
+        pending = outbox.pending
+        await outbox.close(5)
+        return recorder, pending
+
+    recorder, pending = asyncio.run(run())
+    assert pending == 4
+    # Only a status waiting at the back of the queue is replaced, one behind another message is kept
+    assert recorder.labels == ['reply', 'queued 2', 'other', 'queued 1']
+
+
+def test_deletes_keep_their_place_but_skip_the_chat_rate():
+    async def run():
+        outbox, recorder = _outbox(chat_rate=5), _Recorder()
+        outbox.post(PRIVATE, recorder.send('reply 1'))
+        outbox.post(PRIVATE, recorder.send('delete'), limited=False)
+        outbox.post(PRIVATE, recorder.send('reply 2'))
+        await outbox.close(5)
+        return recorder
+
+    recorder = asyncio.run(run())
+    assert recorder.labels == ['reply 1', 'delete', 'reply 2']
+    assert recorder.at('delete') < _SLACK
+    assert 0.2 <= recorder.at('reply 2') < 0.2 + _SLACK
+
+
+def test_close_drains_the_queue():
+    async def run():
+        outbox, recorder = _outbox(chat_rate=10), _Recorder()
+        for label in 'abcde':
+            outbox.post(PRIVATE, recorder.send(label))
+        outbox.post(OTHER, recorder.send('f'))
+        await outbox.close(5)
+        return recorder, outbox.pending
+
+    recorder, pending = asyncio.run(run())
+    assert sorted(recorder.labels) == list('abcdef')
+    assert pending == 0
+    assert 0.4 <= recorder.at('e') < 0.4 + _SLACK
+
+
+def test_close_gives_up_after_timeout():
+    async def run():
+        outbox, recorder = _outbox(chat_rate=10), _Recorder()
+        for label in 'abcde':
+            outbox.post(PRIVATE, recorder.send(label))
+        await outbox.close(0.15)
+        closed = time.monotonic() - recorder.start
+        return recorder, outbox.pending, closed
+
+    recorder, pending, closed = asyncio.run(run())
+    assert recorder.labels == ['a', 'b']
+    assert pending == 3
+    assert 0.15 <= closed < 0.15 + _SLACK
@@ -0,0 +1,84 @@
+import asyncio
+import pathlib
+import socket
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import i18n
+import pytest
+import yaml
+
+import firefly_bot
+from firefly_bot.config import config, init_config
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'benchmarks'))
+
+import stub_bot_api  # noqa: E402
+
+USER = 42
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def api():
+    """The stub Bot API, serving on a free port until the test is done."""
+    api = stub_bot_api.StubBotApi([], [], 0, False, 30, 1)
+    server = ThreadingHTTPServer(('localhost', 0), stub_bot_api._handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api.port = server.server_address[1]
+    yield api
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def webhook_config(api, tmp_path):
+    port = _free_port()
+    path = tmp_path / 'config.yml'
+    path.write_text(yaml.dump({
+        'telegram': {
+            'token': '123456:stub',
+            'mode': 'webhook',
+            'webhook': {'listen': '127.0.0.1', 'port': port, 'url': f'http://localhost:{port}'},
+            'base_url': f'http://localhost:{api.port}/bot',
+            'base_file_url': f'http://localhost:{api.port}/file/bot'
+        },
+        'bot': {'users': [USER], 'logging': {'level': 'WARNING'}}
+    }))
+    config.clear()
+    init_config(str(path))
+    yield config
+    config.clear()
+
+
+def test_webhook_reply_reaches_the_api(api, webhook_config):
+    api.add_text(USER, '/help')
+
+    async def run():
+        application = firefly_bot._build_application()
+        # Neither Firefly nor the worker pool is needed to answer /help
+        application.job_queue.scheduler.remove_all_jobs()
+        async with application:
+            await application.updater.start_webhook(**firefly_bot._get_webhook_options())
+            await application.start()
+            api.release()
+
+            deadline = time.monotonic() + 10
+            while not api.texts[USER] and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+            await application.updater.stop()
+            await application.stop()
+
+    asyncio.run(run())
+    assert api.stats['setWebhook'] == 1
+    assert api.stats['webhook 200'] == 1
+    assert api.texts[USER] == [i18n.t('general.help')]